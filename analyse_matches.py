@@ -1,12 +1,19 @@
+import argparse
 import json
 import random
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import bs4
 import verovio as vrv
 from tqdm import tqdm
 
+import match_store
+from build_manifest import BuildManifest, digest, pattern_inputs, song_user_hashes
+from pattern_store import (build_note_index, candidate_positions, classify_overlap, contained1in2, contained2in1,
+                           group_by_song, intersect, load_pattern_store, note_order, note_spans,
+                           overlapping_positions)
+
 minWidth = 100
 minHeight = 500
 import pandas as pd
@@ -16,10 +23,7 @@ system_start = 1025
 textline_start = 2408
 system_height = 2255 ## we want that all text is below its designated system - > we will determine the center y of rectangle and accordingly set the y of text
 output_folder = "Song_Excel_Files_MARIJA (SVG)"
-intersect = 'intersect'
 contained = 'contained'
-contained1in2 = 'contained1in2'
-contained2in1 = 'contained2in1'
 
 def get_text_y(rect):
     rect_center_y = max((rect[1] + (rect[3] // 2)) - 1025, 0)
@@ -32,79 +36,151 @@ def contains_same_location(locations, new_location):
             return True, loc
     return False, None
 
-def generate_analysis(user1, user2):
+def classify_spans(span, span2):
+    # classify_overlap for two patterns that are each a contiguous run of the score's notes
+    (start, end), (start2, end2) = span, span2
+    if end < start2 or end2 < start:
+        return None
+    if start2 <= start and end <= end2:
+        return intersect if start == start2 or end == end2 else contained1in2
+    if start <= start2 and end2 <= end:
+        return intersect if start == start2 or end == end2 else contained2in1
+    return intersect
+
+def user_pairs(users):
+    return [(users[a], users[b]) for a in range(len(users)) for b in range(a + 1, len(users))]
+
+def song_matches(song_patterns, users, order=None):
+    """
+    Overlaps between the patterns of every pair of `users` in one song. Returns
+    {(user1, user2): [(record1, record2, match_type), ...]} for all pairs with user1 before
+    user2 in `users`; each list is ordered by user1 pattern, then user2 pattern.
+
+    With the song's note order (pattern_store.note_order) the patterns become spans of the
+    score: overlapping pairs come from a sweep over the spans, and two patterns that are both
+    contiguous runs of the score are classified by their ends alone. Patterns with gaps or
+    notes missing from the score fall back to comparing note sets, as all patterns do without
+    an order.
+    """
+    rank = {user: k for k, user in enumerate(users)}
+    matches = {pair: [] for pair in user_pairs(users)}
+    song_patterns = song_patterns[song_patterns['user_id'].isin(users)]
+
+    user_ids = song_patterns['user_id'].tolist()
+    records = song_patterns['record'].tolist()
+    spans, exact = note_spans(records, order)
+    overlaps = overlapping_positions(spans)
+    note_index = build_note_index(song_patterns, order)
+    # note sets only for the patterns compared note by note, and only while this song is compared
+    note_sets = {}
+
+    def note_set(pos):
+        if pos not in note_sets:
+            note_sets[pos] = records[pos].note_set()
+        return note_sets[pos]
+
+    for pos, record in enumerate(records):
+        if not record.codes:
+            continue
+        user1 = users[rank[user_ids[pos]]]
+        candidates = overlaps.get(pos, set())
+        if not exact[pos]:
+            candidates = candidates.union(candidate_positions(note_set(pos), note_index))
+        for pos2 in sorted(candidates):
+            if rank[user_ids[pos2]] <= rank[user1]:
+                continue
+            record2 = records[pos2]
+            if exact[pos] and exact[pos2]:
+                match_type = classify_spans(spans[pos], spans[pos2])
+            else:
+                match_type = classify_overlap(record.codes, note_set(pos), record2.codes, note_set(pos2))
+            if match_type is None:
+                continue
+            user2 = users[rank[user_ids[pos2]]]
+            matches[(user1, user2)].append((record, record2, match_type))
+    return matches
+
+_worker_songs = None
+
+def _init_worker(songs):
+    # every worker receives the parsed store once instead of re-reading the CSV per task
+    global _worker_songs
+    _worker_songs = songs
+
+def _song_task(song_id, users):
+    return song_id, song_matches(_worker_songs[song_id], users, note_order(song_id))
+
+def write_matches(song_id, pair_matches, write_json=False):
+    match_store.write_song(song_id, pair_matches)
+    if not write_json:
+        return
+    for (user1, user2), matches in pair_matches.items():
+        with open(os.path.join('results', f'{song_id}_{user1}_{user2}.json'), 'w') as f:
+            json.dump([(record1.to_json(), record2.to_json(), match_type)
+                       for record1, record2, match_type in matches], f)
+
+def match_outputs(song_id, users, write_json=False):
+    outputs = [match_store.song_path(song_id)]
+    if write_json:
+        outputs += [os.path.join('results', f'{song_id}_{user1}_{user2}.json') for user1, user2 in user_pairs(users)]
+    return outputs
+
+def generate_all_analyses(users, patterns=None, workers=1, write_json=False, incremental=False):
+    """
+    Every run records its inputs in build_manifest.json; with incremental=True only songs whose
+    pattern rows (for `users`) changed since they were last compared are compared again.
+    """
     song_files = os.listdir('Song_Excel_Files')
-    patterns = pd.read_csv('PatternVsi (standardized).csv')
-    # patterns['found'] = False
-    # found = 0
-    for song_id in tqdm(range(22)):
-        song_patterns = patterns[patterns['song_id'] == song_id]
-        song_patterns1 = song_patterns[song_patterns['user_id'] == user1]
-        song_patterns2 = song_patterns[song_patterns['user_id'] == user2]
+    if patterns is None:
+        patterns = load_pattern_store()
+    songs = group_by_song(patterns)
 
+    song_ids = []
+    for song_id in range(22):
         if (not os.path.exists(output_folder + '/' + str(song_id))):
             os.makedirs(output_folder + '/' + str(song_id))
-
-        song_paths = [f for f in song_files if int(f[:3]) == song_id]
-
-        matches = []
-
-        for song_path in song_paths:
-            svg_output = open(os.path.join('Song_Excel_Files', song_path), 'r').read()
-            svg_soup = bs4.BeautifulSoup(svg_output, 'xml')
-            page_margin = svg_soup.find('g', attrs={'class': 'page-margin'})
-            colors = {
-                user1: 'red',
-                user2: 'blue',
-                intersect: 'green',
-                contained: 'violet',
-            }
-            for i, pattern in song_patterns1.iterrows():
-
-                soup = bs4.BeautifulSoup(pattern['xml_file'], 'xml')
-                notes = soup.find_all('note')
-                if not notes:
-                    continue
-                note_ids = [n['xml:id'] for n in notes if n.has_attr('xml:id')]
-
-                for j, p in song_patterns2.iterrows():
-                    soup2 = bs4.BeautifulSoup(p['xml_file'], 'xml')
-                    notes2 = soup2.find_all('note')
-                    if not notes2:
-                        continue
-                    note_ids2 = [n['xml:id'] for n in notes2 if n.has_attr('xml:id')]
-
-                    if not any([n in note_ids2 for n in note_ids]):
-                        continue
-
-                    mask1 = [n in note_ids2 for n in note_ids]
-                    mask2 = [n in note_ids for n in note_ids2]
-
-                    if all(mask1):
-                        # prvi je mogoce contained v drugem
-                        if mask2[0] or mask2[-1]:
-                            # imamo overlap
-                            matches.append(((note_ids, pattern['pattern_tag'], i), (note_ids2, p['pattern_tag'], j), intersect))
-                        else:
-                            matches.append(((note_ids, pattern['pattern_tag'], i), (note_ids2, p['pattern_tag'], j), contained1in2))
-                    elif all(mask2):
-                        if mask1[0] or mask1[-1]:
-                            matches.append(((note_ids, pattern['pattern_tag'], i), (note_ids2, p['pattern_tag'], j), intersect))
-                        else:
-                            matches.append(((note_ids, pattern['pattern_tag'], i), (note_ids2, p['pattern_tag'], j), contained2in1))
-                    else:
-                        matches.append(((note_ids, pattern['pattern_tag'], i), (note_ids2, p['pattern_tag'], j), intersect))
-
-            with open(os.path.join('results', f'{song_id}_{user1}_{user2}.json'), 'w') as f:
-                json.dump(matches, f)
+        if any(int(f[:3]) == song_id for f in song_files):
+            song_ids.append(song_id)
+            if song_id not in songs:
+                songs[song_id] = patterns.iloc[:0]
+
+    manifest = BuildManifest()
+    hashes = song_user_hashes(patterns)
+    inputs = {song_id: digest(pattern_inputs(hashes, song_id, users), write_json) for song_id in song_ids}
+    key = {song_id: f"{song_id}/{'_'.join(map(str, users))}" for song_id in song_ids}
+    if incremental:
+        song_ids = [song_id for song_id in song_ids
+                    if not manifest.is_current('analyse_matches', key[song_id], inputs[song_id])]
+        print(f"{len(song_ids)} songs changed since the last run")
+
+    def done(song_id, pair_matches):
+        write_matches(song_id, pair_matches, write_json)
+        manifest.record('analyse_matches', key[song_id], inputs[song_id], match_outputs(song_id, users, write_json))
+
+    if workers > 1:
+        songs = {song_id: songs[song_id] for song_id in song_ids}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(songs,)) as pool:
+            futures = [pool.submit(_song_task, song_id, users) for song_id in song_ids]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                song_id, pair_matches = future.result()
+                done(song_id, pair_matches)
+    else:
+        for song_id in tqdm(song_ids):
+            done(song_id, song_matches(songs[song_id], users, note_order(song_id)))
+    manifest.save()
+
+def generate_analysis(user1, user2, patterns=None, workers=1, write_json=False, incremental=False):
+    generate_all_analyses([user1, user2], patterns, workers, write_json, incremental)
 
 
 if __name__ == '__main__':
-    users = [36, 46, 48, 49, 51]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes (songs are split between them)')
+    parser.add_argument('--json', action='store_true',
+                        help='also write the legacy results/{song}_{u1}_{u2}.json files next to the binary match store')
+    parser.add_argument('--incremental', action='store_true', help='only redo songs whose patterns changed (build_manifest.json)')
+    args = parser.parse_args()
 
-    for i in range(len(users)):
-        for j in range(i + 1, len(users)):
-            print(f'{users[i]} -> {users[j]}')
-            generate_analysis(users[i], users[j])
+    users = [36, 46, 48, 49, 51]
+    generate_all_analyses(users, workers=args.workers, write_json=args.json, incremental=args.incremental)
     # generate_analysis(users[0], users[3])
-
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+from pattern_cache import file_hash
+
+try:
+    import fcntl
+except ImportError:  # no flock (Windows): concurrent saves are not serialised there
+    fcntl = None
+
+manifest_file = 'build_manifest.json'
+
+# build_manifest.json:
+#   targets  {target: {key: {'inputs': digest, 'outputs': [paths]}}}; a key is rebuilt when the
+#            digest of its inputs differs from the recorded one or one of its outputs is missing
+# Every script saves into the same file, so save() merges under a lock (build_manifest.json.lock).
+
+
+def digest(*parts):
+    """
+    sha256 of any JSON-serialisable values (numpy scalars are written through str()).
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def song_user_hashes(patterns):
+    """
+    {(song_id, user_id): hash of that user's pattern rows in that song}. Every column except the
+    parsed 'record' takes part, so any edit to a row (tag, rank, notes, ...) changes the hash.
+    """
+    columns = [column for column in patterns.columns if column != 'record']
+    hashes = {}
+    for (song_id, user_id), rows in patterns.groupby(['song_id', 'user_id']):
+        hashes[(int(song_id), int(user_id))] = digest(rows.index.tolist(), rows[columns].values.tolist())
+    return hashes
+
+
+def pattern_inputs(hashes, song_id, users):
+    """
+    Digest of the pattern rows of `users` in one song (users without rows count as empty).
+    """
+    return digest([(int(user), hashes.get((int(song_id), int(user)))) for user in users])
+
+
+def file_inputs(paths):
+    """
+    Digest of the contents of files (in the given order).
+    """
+    return digest([(os.path.basename(path), file_hash(path) if os.path.exists(path) else None) for path in paths])
+
+
+def _read_targets(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f).get('targets', {})
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+@contextmanager
+def _locked(path):
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class BuildManifest:
+    """
+    Input digests and outputs of everything the pipeline has built, so that reruns only redo
+    the keys (songs, user pairs, ...) whose inputs changed.
+    """
+
+    def __init__(self, path=manifest_file):
+        self.path = path
+        self.targets = _read_targets(path)
+        # the entries recorded by this run; save() writes only these
+        self.recorded = {}
+
+    def is_current(self, target, key, inputs):
+        entry = self.targets.get(target, {}).get(str(key))
+        return (entry is not None and entry['inputs'] == inputs
+                and all(os.path.exists(path) for path in entry['outputs']))
+
+    def record(self, target, key, inputs, outputs):
+        entry = {'inputs': inputs, 'outputs': list(outputs)}
+        self.targets.setdefault(target, {})[str(key)] = entry
+        self.recorded.setdefault(target, {})[str(key)] = entry
+
+    def save(self):
+        """
+        Merges the recorded entries into the manifest file. The file is read again under the
+        lock, so entries other scripts (or runs) saved since this one started are kept.
+        """
+        with _locked(self.path + '.lock'):
+            targets = _read_targets(self.path)
+            for target, entries in self.recorded.items():
+                targets.setdefault(target, {}).update(entries)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'targets': targets}, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        self.targets = targets
+        self.recorded = {}
@@ -1,6 +1,12 @@
+import argparse
 import pandas as pd
-import xml.etree.ElementTree as ET
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from pattern_cache import load_table
+from score_parsing import XML_ERRORS, NAMESPACES, mei_notes, parse_mei
 
 # --- CONFIGURE YOUR FILES HERE ---
 
@@ -25,12 +31,14 @@ PATTERN_COLORS = {
     "Pat-3": "#E76F51",  # Orange/Coral
 }
 
-# --- NAMESPACES FOR MEI XML ---
-# This is necessary for parsing MEI files correctly.
-NAMESPACES = {
-    'mei': 'http://www.music-encoding.org/ns/mei',
-    'xml': 'http://www.w3.org/XML/1998/namespace'
-}
+# 4. Batch mode (--batch): every song of SCORE_FOLDER, for any users and tags.
+#    Tags without an entry in PATTERN_COLORS take the next color of EXTRA_COLORS.
+#    The colored scores go to their own folder, not over the committed "Song_Excel_Files (SVG)".
+USER_FILE = "./User_Excel_Files/User{}_standardized.xlsx"
+SCORE_FOLDER = "./Song_Excel_Files"
+OUTPUT_FOLDER = "./Song_Excel_Files (colored)"
+EXTRA_COLORS = ['#2596be', '#FF9333', '#FF33AB', '#BB33FF', '#2CE1A5', '#CDD136', '#D1AF36', '#D18136',
+                '#800080', '#008000', '#800000', '#000080', '#008080']
 
 def get_note_id_to_pattern_map():
     """
@@ -38,9 +46,9 @@ def get_note_id_to_pattern_map():
     and returns a dictionary mapping note xml:id's to a pattern_tag.
     """
     try:
-        # *** UPDATED to use pd.read_excel() ***
-        df36 = pd.read_excel(USER36_FILE)
-        df51 = pd.read_excel(USER51_FILE)
+        # read through the Parquet cache (pattern_cache.py); the workbooks are only opened when they change
+        df36 = load_table(USER36_FILE)
+        df51 = load_table(USER51_FILE)
     except FileNotFoundError as e:
         print(f"Error: Could not find file. {e}")
         print("Please make sure your .xlsx files are in the same directory as this script.")
@@ -67,28 +75,14 @@ def get_note_id_to_pattern_map():
         print(f"  Found {len(df_filtered)} pattern instances for User {user_id}...")
 
         for _, row in df_filtered.iterrows():
-            xml_data = row['xml_file']
             pattern_tag = row['pattern_tag']
 
-            try:
-                # Parse the XML string from the CSV
-                snippet_root = ET.fromstring(xml_data)
-
-                # Find all <note> elements within this snippet
-                notes = snippet_root.findall('.//mei:note', NAMESPACES)
-
-                for note in notes:
-                    # Get the 'xml:id' of the note
-                    note_id = note.get(f"{{{NAMESPACES['xml']}}}id")
-                    if note_id:
-                        # Add to map. If users overlap on a note,
-                        # the last one processed (User 51) will "win".
-                        note_map[note_id] = pattern_tag
-
-            except ET.ParseError as e:
-                print(f"    Warning: Skipping row. Could not parse XML for User {user_id}, {pattern_tag}. Error: {e}")
-            except Exception as e:
-                print(f"    Warning: An unexpected error occurred processing a row. {e}")
+            # The xml:id of every <note> of the snippet, extracted when the cache was built
+            for note_id in row['note_ids']:
+                if note_id:
+                    # Add to map. If users overlap on a note,
+                    # the last one processed (User 51) will "win".
+                    note_map[note_id] = pattern_tag
 
     # Process both users
     process_df(df36, 36)
@@ -112,16 +106,12 @@ def color_full_score_xml(note_map, full_score_path, output_path):
     print(f"Loading full score from '{full_score_path}'...")
 
     try:
-        # Register namespaces to make sure they are preserved on save
-        for prefix, uri in NAMESPACES.items():
-            ET.register_namespace(prefix, uri)
-
-        # Parse the entire XML file
-        tree = ET.parse(full_score_path)
+        # Parse the entire XML file (namespace prefixes are preserved on save)
+        tree = parse_mei(full_score_path)
         root = tree.getroot()
 
         # Find all note elements in the *entire* score
-        all_notes = root.findall('.//mei:note', NAMESPACES)
+        all_notes = mei_notes(root)
 
         if not all_notes:
             print("Warning: Found 0 notes in the full score. Are you sure this is a valid MEI file?")
@@ -151,17 +141,123 @@ def color_full_score_xml(note_map, full_score_path, output_path):
         print(f"Modified score saved to: '{output_path}'")
         return True
 
-    except ET.ParseError as e:
+    except XML_ERRORS as e:
         print(f"Error: Could not parse the full score file. Is it valid XML/MEI? {e}")
         return False
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         return False
 
+def read_user_patterns(users):
+    """
+    Reads the workbook of every user once and returns all their rows in one frame,
+    in the order of `users`.
+    """
+    frames = []
+    for user_id in users:
+        df = load_table(USER_FILE.format(user_id))
+        df['user_id'] = user_id
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+def tag_colors(tags):
+    """
+    Color of every tag: PATTERN_COLORS where it has one, otherwise the next EXTRA_COLORS entry.
+    """
+    colors = {}
+    extra = 0
+    for tag in tags:
+        if tag in PATTERN_COLORS:
+            colors[tag] = PATTERN_COLORS[tag]
+        else:
+            colors[tag] = EXTRA_COLORS[extra % len(EXTRA_COLORS)]
+            extra += 1
+    return colors
+
+def build_song_color_maps(patterns, colors):
+    """
+    One note xml:id -> color map per song_id. Where users overlap on a note, the row that comes
+    last (i.e. the last user) wins, as in the single-song mode.
+    """
+    color_maps = {}
+    for song_id, song_patterns in patterns.groupby('song_id'):
+        color_map = {}
+        for tag, note_ids in zip(song_patterns['pattern_tag'], song_patterns['note_ids']):
+            for note_id in note_ids:
+                color_map[note_id] = colors[tag]
+        color_maps[song_id] = color_map
+    return color_maps
+
+def song_score_files(folder=SCORE_FOLDER):
+    """
+    Maps song_id to the score file of that song (files are named NNN_<title>.xml).
+    """
+    return {int(name[:3]): name for name in sorted(os.listdir(folder))
+            if name.endswith('.xml') and name[:3].isdigit()}
+
+def color_score(color_map, score_path, output_path):
+    """
+    Parses one score, sets the color of every note in color_map and writes it out.
+    Returns the number of colored notes.
+    """
+    tree = parse_mei(score_path)
+    colored_note_count = 0
+    for note in mei_notes(tree.getroot()):
+        color = color_map.get(note.get(f"{{{NAMESPACES['xml']}}}id"))
+        if color:
+            note.set('color', color)
+            colored_note_count += 1
+    tree.write(output_path, encoding='UTF-8', xml_declaration=True)
+    return colored_note_count
+
+def color_all_songs(users, tags=None, songs=None, workers=1, score_folder=SCORE_FOLDER, output_folder=OUTPUT_FOLDER):
+    """
+    Batch mode: colors the patterns of `users` (restricted to `tags`, if given) in the score of
+    every song (or of `songs`), each score parsed and written once.
+    """
+    patterns = read_user_patterns(users)
+    if tags:
+        patterns = patterns[patterns['pattern_tag'].isin(tags)]
+    colors = tag_colors(tags if tags else patterns['pattern_tag'].unique())
+    color_maps = build_song_color_maps(patterns, colors)
+
+    score_files = song_score_files(score_folder)
+    if songs is not None:
+        score_files = {song_id: name for song_id, name in score_files.items() if song_id in songs}
+    os.makedirs(output_folder, exist_ok=True)
+    jobs = {song_id: (color_maps.get(song_id, {}), os.path.join(score_folder, name), os.path.join(output_folder, name))
+            for song_id, name in score_files.items()}
+
+    counts = {}
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(color_score, *job): song_id for song_id, job in jobs.items()}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                counts[futures[future]] = future.result()
+    else:
+        for song_id, job in tqdm(jobs.items()):
+            counts[song_id] = color_score(*job)
+
+    for song_id in sorted(counts):
+        print(f"Song {song_id}: colored {counts[song_id]} notes -> '{jobs[song_id][2]}'")
+    return counts
+
 def main():
     note_map = get_note_id_to_pattern_map()
     if note_map:
         color_full_score_xml(note_map, FULL_SCORE_FILE, OUTPUT_FILE)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', action='store_true', help='color every song instead of the configured song 0 file')
+    parser.add_argument('--users', type=int, nargs='+', default=[36, 46, 48, 49, 51])
+    parser.add_argument('--tags', nargs='+', help='only these pattern tags (default: all tags)')
+    parser.add_argument('--songs', type=int, nargs='+', help='only these song ids (default: all songs)')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes (songs are split between them)')
+    parser.add_argument('--output', default=OUTPUT_FOLDER, help='folder for the colored scores')
+    args = parser.parse_args()
+
+    if args.batch:
+        color_all_songs(args.users, args.tags, args.songs, args.workers, output_folder=args.output)
+    else:
+        main()
\ No newline at end of file
@@ -1,8 +1,13 @@
-import pandas as pd
-import altair as alt
+import argparse
 import os
+import re
 import zipfile
 
+import pandas as pd
+import altair as alt
+
+from pattern_cache import load_table
+
 # List of files and user names
 files_info = {
     "User 36": "User36.xlsx - Tabelle1.csv",
@@ -15,132 +20,165 @@ files_info = {
 # Define the zip file name
 zip_file_name = 'all_charts_high_quality.zip'
 
-# To store all loaded dataframes
-dfs = {}
-
-try:
-    print("Loading data files...")
-    # --- 1. Load all data ---
-    for user, file_name in files_info.items():
-        if not os.path.exists(file_name):
-            print(f"!!! ERROR: File not found: {file_name}")
-            print("Please make sure all CSV files are in the same directory as this script.")
-            exit()
-        dfs[user] = pd.read_csv(file_name)
-    print("All data loaded successfully.")
-
-    # --- 2. Create Zip File and Add Charts One by One ---
-    with zipfile.ZipFile(zip_file_name, 'w', zipfile.ZIP_DEFLATED) as zf:
-        print(f"Created '{zip_file_name}'. Adding charts...")
-
-        # --- Chart: User 36 ---
-        file_36 = 'user_36_patterns_chart.json'
-        data_36 = dfs['User 36']['pattern_tag'].value_counts().reset_index().rename(
-            columns={'index': 'Pattern Tag', 'pattern_tag': 'Occurrences'}
-        )
-        chart_36 = alt.Chart(data_36).mark_bar().encode(
-            x=alt.X('Pattern Tag', sort=alt.EncodingSortField(field="Occurrences", op="sum", order='descending')),
-            y=alt.Y('Occurrences'),
-            tooltip=['Pattern Tag', 'Occurrences']
-        ).properties(title='Pattern Occurrences: User 36').interactive()
-        chart_36.save(file_36)
-        zf.write(file_36)
-        os.remove(file_36)
-        print(f"Added {file_36}")
-
-        # --- Chart: User 51 ---
-        file_51 = 'user_51_patterns_chart.json'
-        data_51 = dfs['User 51']['pattern_tag'].value_counts().reset_index().rename(
-            columns={'index': 'Pattern Tag', 'pattern_tag': 'Occurrences'}
-        )
-        chart_51 = alt.Chart(data_51).mark_bar().encode(
-            y=alt.Y('Pattern Tag', sort=alt.EncodingSortField(field="Occurrences", op="sum", order='descending')),
-            x=alt.X('Occurrences'),
-            tooltip=['Pattern Tag', 'Occurrences']
-        ).properties(title='Pattern Occurrences: User 51').interactive()
-        chart_51.save(file_51)
-        zf.write(file_51)
-        os.remove(file_51)
-        print(f"Added {file_51}")
-
-        # --- Charts: Users 46, 48, 49 ---
-        for user_name in ['User 46', 'User 48', 'User 49']:
-            chart_file_name = f"{user_name.lower().replace(' ', '_')}_patterns_chart.json"
-            data = dfs[user_name]['pattern_tag'].value_counts().reset_index().rename(
-                columns={'index': 'Pattern Tag', 'pattern_tag': 'Occurrences'}
-            )
-            chart = alt.Chart(data).mark_bar().encode(
-                y=alt.Y('Pattern Tag', sort=alt.EncodingSortField(field="Occurrences", op="sum", order='descending')),
-                x=alt.X('Occurrences'),
-                tooltip=['Pattern Tag', 'Occurrences']
-            ).properties(title=f'Pattern Occurrences: {user_name}').interactive()
-
-            chart.save(chart_file_name)
-            zf.write(chart_file_name)
-            os.remove(chart_file_name)
-            print(f"Added {chart_file_name}")
-
-        # --- Chart: All Users Comparison ---
-        file_all_users = 'all_users_comparison_chart.json'
-        summary_data = []
-        for user, df in dfs.items():
-            summary_data.append({"User": user, "Metric": "Total Occurrences", "Count": len(df)})
-            summary_data.append({"User": user, "Metric": "Unique Patterns", "Count": df['pattern_tag'].nunique()})
-
-        summary_df = pd.DataFrame(summary_data)
-        chart_all_users = alt.Chart(summary_df).mark_bar().encode(
-            x=alt.X('User', axis=None),
-            y=alt.Y('Count', title='Count'),
-            color=alt.Color('User', title='User'),
-            column=alt.Column('Metric', title='Metric', header=alt.Header(titleOrient="bottom", labelOrient="bottom")),
-            tooltip=['User', 'Metric', 'Count']
-        ).properties(title='Pattern Occurrences and Variety by User').interactive()
-        chart_all_users.save(file_all_users)
-        zf.write(file_all_users)
-        os.remove(file_all_users)
-        print(f"Added {file_all_users}")
-
-        # --- Chart: Top 20 Standardized ---
-        file_standardized = 'top_20_standardized_patterns_chart.json'
-
-
-        def standardize_tag(tag):
-            tag_str = str(tag).lower().strip()
-            if tag_str.startswith('sub.vz'): return tag_str[7:]
-            if tag_str.startswith('pat-'): return tag_str[4:]
-            if tag_str.startswith('vz'): return tag_str[2:]
-            if tag_str.startswith('sub-'): return tag_str[4:]
-            return tag_str
-
-
-        all_dfs = []
-        for user, df in dfs.items():
-            df_copy = df.copy()
-            df_copy['User'] = user
-            all_dfs.append(df_copy)
-
-        all_data = pd.concat(all_dfs, ignore_index=True)
-        all_data['standardized_tag'] = all_data['pattern_tag'].apply(standardize_tag)
-
-        top_20_tags_overall = all_data['standardized_tag'].value_counts().head(20).reset_index()
-        top_20_tags_overall.columns = ['Standardized Tag', 'Total Occurrences']  # Renaming for clarity
-        top_20_tag_list = top_20_tags_overall['Standardized Tag'].tolist()
-
-        chart_data = all_data[all_data['standardized_tag'].isin(top_20_tag_list)]
-        chart_data_grouped = chart_data.groupby(['standardized_tag', 'User']).size().reset_index(name='Occurrences')
-
-        chart_standardized = alt.Chart(chart_data_grouped).mark_bar().encode(
-            x=alt.X('standardized_tag', title='Standardized Pattern Tag', sort=top_20_tag_list),
-            y=alt.Y('Occurrences', title='Total Occurrences'),
-            color=alt.Color('User', title='User'),
-            tooltip=['standardized_tag', 'User', 'Occurrences']
-        ).properties(title='Top 20 Standardized Patterns by User').interactive()
-        chart_standardized.save(file_standardized)
-        zf.write(file_standardized)
-        os.remove(file_standardized)
-        print(f"Added {file_standardized}")
-
-    print(f"\nSuccessfully created '{zip_file_name}' with all 7 charts.")
-
-except Exception as e:
-    print(f"An error occurred: {e}")
\ No newline at end of file
+# these users' charts have the tags on the x axis, everybody else's on the y axis
+vertical_users = {'User 36'}
+
+# (prefix, where the standardized tag starts), the first matching prefix wins
+tag_prefixes = [('sub.vz', 7), ('pat-', 4), ('vz', 2), ('sub-', 4)]
+
+
+def user_label(path):
+    """
+    'User 36' for User36.xlsx - Tabelle1.csv, User36_standardized.xlsx, ...
+    """
+    match = re.search(r'User\s*(\d+)', os.path.basename(path))
+    return f"User {match.group(1)}" if match else os.path.splitext(os.path.basename(path))[0]
+
+
+def standardize_tags(tags):
+    """
+    Lower-cased, stripped tags without their 'sub.vz', 'pat-', 'vz' or 'sub-' prefix.
+    """
+    tags = tags.astype(str).fillna('nan').str.lower().str.strip()
+    standardized = tags.copy()
+    remaining = pd.Series(True, index=tags.index)
+    for prefix, start in tag_prefixes:
+        hit = remaining & tags.str.startswith(prefix)
+        standardized[hit] = tags[hit].str[start:]
+        remaining &= ~hit
+    return standardized
+
+
+def load_patterns(files):
+    """
+    The pattern tags of all users as one frame with categorical User, pattern_tag and
+    standardized_tag columns. Every distinct tag is standardized once, not every row.
+    """
+    frames = [load_table(file_name)[['pattern_tag']].assign(User=user) for user, file_name in files.items()]
+    all_data = pd.concat(frames, ignore_index=True)
+    all_data['User'] = pd.Categorical(all_data['User'], categories=list(files))
+    all_data['pattern_tag'] = all_data['pattern_tag'].astype('category')
+
+    tags = all_data['pattern_tag'].cat
+    standardized = standardize_tags(pd.Series(tags.categories.tolist() + [float('nan')]))
+    # code -1 (a missing tag) picks the last entry, which standardizes like str(nan) did
+    all_data['standardized_tag'] = pd.Categorical(standardized.to_numpy()[tags.codes])
+    return all_data
+
+
+def count_patterns(all_data):
+    """
+    One groupby over (User, pattern_tag, standardized_tag), reduced to everything the charts need:
+    per user tag counts, total and unique counts, and the counts of the top 20 standardized tags.
+
+    Tags are ranked by count; tags with the same count keep the order in which they first occur
+    in the data (the files in order, rows in order), as value_counts() ranks them. The groupby
+    itself orders tags alphabetically, so both rankings are put back into first-occurrence order
+    before the stable sort.
+    """
+    counts = all_data.groupby(['User', 'pattern_tag', 'standardized_tag'], observed=True, dropna=False).size()
+
+    tag_counts = counts[counts.index.get_level_values('pattern_tag').notna()]
+    tag_counts = tag_counts.groupby(level=['User', 'pattern_tag'], observed=True).sum()
+    first_seen = all_data[['User', 'pattern_tag']].dropna().drop_duplicates()
+    tag_counts = tag_counts.reindex(pd.MultiIndex.from_frame(first_seen))
+    totals = counts.groupby(level='User', observed=True).sum()
+    unique = tag_counts.groupby(level='User', observed=True).size()
+
+    standardized = counts.groupby(level=['standardized_tag', 'User'], observed=True).sum()
+    overall = standardized.groupby(level='standardized_tag', observed=True).sum()
+    overall = overall.reindex(all_data['standardized_tag'].unique())
+    top_20_tag_list = overall.sort_values(ascending=False, kind='stable').head(20).index.tolist()
+    top_20 = standardized[standardized.index.get_level_values('standardized_tag').isin(top_20_tag_list)]
+    return tag_counts, totals, unique, top_20, top_20_tag_list
+
+
+def user_chart(user, tag_counts):
+    data = tag_counts.loc[user].sort_values(ascending=False, kind='stable').reset_index()
+    data.columns = ['Pattern Tag', 'Occurrences']
+    data['Pattern Tag'] = data['Pattern Tag'].astype(str)
+    tag = alt.EncodingSortField(field="Occurrences", op="sum", order='descending')
+    if user in vertical_users:
+        encoding = {'x': alt.X('Pattern Tag', sort=tag), 'y': alt.Y('Occurrences')}
+    else:
+        encoding = {'y': alt.Y('Pattern Tag', sort=tag), 'x': alt.X('Occurrences')}
+    return alt.Chart(data).mark_bar().encode(
+        tooltip=['Pattern Tag', 'Occurrences'], **encoding
+    ).properties(title=f'Pattern Occurrences: {user}').interactive()
+
+
+def users_comparison_chart(totals, unique):
+    summary_data = []
+    for user in totals.index:
+        summary_data.append({"User": str(user), "Metric": "Total Occurrences", "Count": int(totals[user])})
+        summary_data.append({"User": str(user), "Metric": "Unique Patterns", "Count": int(unique.get(user, 0))})
+
+    summary_df = pd.DataFrame(summary_data)
+    return alt.Chart(summary_df).mark_bar().encode(
+        x=alt.X('User', axis=None),
+        y=alt.Y('Count', title='Count'),
+        color=alt.Color('User', title='User'),
+        column=alt.Column('Metric', title='Metric', header=alt.Header(titleOrient="bottom", labelOrient="bottom")),
+        tooltip=['User', 'Metric', 'Count']
+    ).properties(title='Pattern Occurrences and Variety by User').interactive()
+
+
+def standardized_chart(top_20, top_20_tag_list):
+    chart_data_grouped = top_20.reset_index(name='Occurrences')
+    chart_data_grouped['standardized_tag'] = chart_data_grouped['standardized_tag'].astype(str)
+    chart_data_grouped['User'] = chart_data_grouped['User'].astype(str)
+    return alt.Chart(chart_data_grouped).mark_bar().encode(
+        x=alt.X('standardized_tag', title='Standardized Pattern Tag', sort=top_20_tag_list),
+        y=alt.Y('Occurrences', title='Total Occurrences'),
+        color=alt.Color('User', title='User'),
+        tooltip=['standardized_tag', 'User', 'Occurrences']
+    ).properties(title='Top 20 Standardized Patterns by User').interactive()
+
+
+def build_charts(files):
+    """
+    [(file name in the zip, chart)] for every user, the user comparison and the top 20 tags.
+    """
+    tag_counts, totals, unique, top_20, top_20_tag_list = count_patterns(load_patterns(files))
+    charts = [(f"{user.lower().replace(' ', '_')}_patterns_chart.json", user_chart(user, tag_counts))
+              for user in files if user in tag_counts.index.get_level_values('User')]
+    charts.append(('all_users_comparison_chart.json', users_comparison_chart(totals, unique)))
+    charts.append(('top_20_standardized_patterns_chart.json', standardized_chart(top_20, top_20_tag_list)))
+    return charts
+
+
+def write_charts(charts, zip_path=zip_file_name):
+    """
+    Writes the Vega-Lite spec of every chart straight into the zip, in order.
+    """
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        print(f"Created '{zip_path}'. Adding charts...")
+        for file_name, chart in charts:
+            zf.writestr(file_name, chart.to_json())
+            print(f"Added {file_name}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', help='one pattern table per user, named User<N>... (default: files_info)')
+    parser.add_argument('--output', default=zip_file_name, help='zip file to write')
+    args = parser.parse_args()
+    files = {user_label(path): path for path in args.files} if args.files else files_info
+
+    try:
+        print("Loading data files...")
+        # --- 1. Load all data ---
+        for user, file_name in files.items():
+            if not os.path.exists(file_name):
+                print(f"!!! ERROR: File not found: {file_name}")
+                print("Please make sure all CSV files are in the same directory as this script.")
+                exit()
+        charts = build_charts(files)
+        print("All data loaded successfully.")
+
+        # --- 2. Create Zip File and Add Charts ---
+        write_charts(charts, args.output)
+        print(f"\nSuccessfully created '{args.output}' with all {len(charts)} charts.")
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
@@ -1,9 +1,19 @@
+import argparse
 import random
 import os
+from xml.parsers import expat
+
 import verovio as vrv  # Not used in this script, but kept from your original
-import bs4  # <-- ADDED IMPORT
 import numpy as np  # <-- ADDED IMPORT
 import pandas as pd
+import render_scores
+from build_manifest import BuildManifest, digest, file_inputs, pattern_inputs, song_user_hashes
+from pattern_store import group_by_song, load_pattern_store
+from render_pool import RenderTask, report_timings, run_tasks, score_size
+from score_parsing import XML_ERRORS, parse_svg, serialize_svg
+from svg_writer import SvgWriter, output_path, svg_formats
+from svg_index import index_svg, use_xy
+from svg_overlay import overlay_rect, overlay_text, page_margin_end, splice_overlay
 
 # Constants from your script
 minWidth = 100
@@ -21,253 +31,349 @@ def get_text_y(rect):
     return textline_start + indx * system_height
 
 
-def contains_same_location(locations, new_location):
-    for loc in locations:
-        if abs(loc[0] - new_location[0]) < 2 * max(minTextWidth, loc[2]) and abs(
-                loc[1] - new_location[1]) < minTextHeight:
-            return True, loc
-    return False, None
+class LocationGrid:
+    """
+    The obj_locs list of placed boxes and labels, bucketed on a grid so that
+    contains_same_location only looks at nearby entries instead of all of them.
+
+    Rows are minTextHeight tall and columns 2 * minTextWidth wide. A location is filed under
+    its own row and every column its x-reach (2 * max(minTextWidth, width)) touches, so a
+    query only needs its own column and the rows directly above and below. Among the hits
+    the earliest appended location is returned, exactly as a scan of the whole list would.
+    """
+
+    def __init__(self):
+        self.cells = {}
+        self.count = 0
+
+    def append(self, loc):
+        reach = 2 * max(minTextWidth, loc[2])
+        row = int(loc[1] // minTextHeight)
+        first_col = int((loc[0] - reach) // (2 * minTextWidth))
+        last_col = int((loc[0] + reach) // (2 * minTextWidth))
+        for col in range(first_col, last_col + 1):
+            self.cells.setdefault((row, col), []).append((self.count, loc))
+        self.count += 1
+
+    def contains_same_location(self, new_location):
+        row = int(new_location[1] // minTextHeight)
+        col = int(new_location[0] // (2 * minTextWidth))
+        found = None
+        for r in (row - 1, row, row + 1):
+            for order, loc in self.cells.get((r, col), ()):
+                if found is not None and order > found[0]:
+                    continue
+                if abs(loc[0] - new_location[0]) < 2 * max(minTextWidth, loc[2]) and abs(
+                        loc[1] - new_location[1]) < minTextHeight:
+                    found = (order, loc)
+        if found is None:
+            return False, None
+        return True, found[1]
 
 
-def generate_analysis():
-    # --- PRE-REQUISITE ---
-    # This folder 'output_svgs_mei' MUST exist and be filled with
-    # the SVG files of your scores (e.g., "001_song_1.svg", "002_song_2.svg")
-    # ---------------------
-    try:
-        song_files = os.listdir('Song_Excel_Files_MARIJA (SVG)')
-        if not song_files:
-            print("Error: The 'Song_Excel_Files_MARIJA (SVG)' folder is empty.")
-            print("Please fill it with your pre-rendered SVG score files.")
-            return
-    except FileNotFoundError:
-        print("Error: Folder 'Song_Excel_Files_MARIJA (SVG)' not found.")
-        print("Please create this folder and fill it with your pre-rendered SVG score files.")
-        return
+def song_svg_paths(song_id, song_files):
+    song_paths = [f for f in song_files if f.startswith(f"{song_id:03d}")]  # Assumes file naming like 001_...svg
+    if not song_paths:
+        song_paths = [f for f in song_files if f.startswith(f"song_{song_id}")]  # Fallback naming
+    return song_paths
 
-    try:
-        patterns = pd.read_csv('PatternVsi (standardized).csv')
-    except FileNotFoundError:
-        print("Error: 'PatternVsi (standardized).csv' not found.")
+
+def annotated_path(song_path, svg_format='svg'):
+    return output_path(os.path.join('results', f"{song_path.split('.')[0]}_annotated.svg"), svg_format)
+
+
+def annotate_song(song_id, song_patterns, song_files, writer):
+    # seeded per song so that serial and --workers runs place the boxes identically
+    random.seed(song_id)
+    np.random.seed(song_id)
+    song_patterns = song_patterns.copy()
+
+    # --- FIX ---
+    # Removed the 'users' filter to process all users
+    # song_patterns = song_patterns[song_patterns['user_id'].isin(users)]
+    # -----------
+
+    if song_patterns.empty:
+        print(f"--- Song {song_id}: No patterns found. Skipping. ---")
         return
 
-    # Create output directories
-    os.makedirs('songs', exist_ok=True)
-    os.makedirs('results', exist_ok=True)  # <-- ADDED
+    if (not os.path.exists('songs/{}'.format(song_id))):
+        os.makedirs('songs/{}'.format(song_id))
 
-    for song_id in range(22):
-        song_patterns = patterns[patterns['song_id'] == song_id].copy()
+    song_paths = song_svg_paths(song_id, song_files)
 
-        # --- FIX ---
-        # Removed the 'users' filter to process all users
-        # song_patterns = song_patterns[song_patterns['user_id'].isin(users)]
-        # -----------
+    print("---------------------------------------------------")
+    print(f"Processing Song {song_id}. Found {len(song_patterns)} patterns.")
+    if not song_paths:
+        print(f"Warning: No SVG file found for song {song_id} in 'output_svgs_mei'. Skipping.")
+        return
 
-        if song_patterns.empty:
-            print(f"--- Song {song_id}: No patterns found. Skipping. ---")
+    not_found_ids = []
+    found_ids = []
+
+    for song_path in song_paths:
+        print(f"  > Loading SVG: {song_path}")
+        try:
+            svg_output = open(os.path.join('output_svgs_mei', song_path), 'r', encoding='utf-8').read()
+        except Exception as e:
+            print(f"    > Error reading SVG: {e}")
             continue
 
-        if (not os.path.exists('songs/{}'.format(song_id))):
-            os.makedirs('songs/{}'.format(song_id))
+        colors = ['#ff0000', '#00ff00', '#0000ff', '#800080', '#008000', '#800000', '#000080', '#008080', '#800000',
+                  '#2596be', '#FF9333', '#FF33AB', '#BB33FF', '#2CE1A5', '#CDD136', '#D1AF36', '#D18136']
+        lenCol = len(colors)
+        categories = song_patterns['pattern_tag'].unique()
 
-        song_paths = [f for f in song_files if f.startswith(f"{song_id:03d}")]  # Assumes file naming like 001_...svg
-        if not song_paths:
-            song_paths = [f for f in song_files if f.startswith(f"song_{song_id}")]  # Fallback naming
+        # This visualizes SIMILARITY OF TAG
+        for i, category in enumerate(categories):
+            song_patterns.loc[song_patterns['pattern_tag'] == category, 'color'] = colors[i % lenCol]
 
-        print("---------------------------------------------------")
-        print(f"Processing Song {song_id}. Found {len(song_patterns)} patterns.")
-        if not song_paths:
-            print(f"Warning: No SVG file found for song {song_id} in 'output_svgs_mei'. Skipping.")
+        # --- FIX ---
+        # This line was unused and 'users' is undefined
+        # user_colors = {user: colors[user % len(colors)] for user in users}
+        # -----------
+
+        # the boxes and labels are collected as markup and spliced into the original text at
+        # the end; the parsed tree is only used to look notes up
+        try:
+            margin_end = page_margin_end(svg_output)
+        except expat.ExpatError:
+            # not well-formed: the overlay goes into the SVG as parse_svg recovers it
+            try:
+                svg_output = serialize_svg(parse_svg(svg_output))
+            except XML_ERRORS as error:
+                print(f"    > Warning: {song_path} is not well-formed XML ({error}).")
+                print("    > Annotations will be skipped.")
+                continue
+            margin_end = page_margin_end(svg_output)
+        if margin_end < 0:
+            print(f"    > Warning: Could not find <g class='page-margin'> in {song_path}.")
+            print("    > Annotations will be skipped. Is this a Verovio SVG?")
             continue
 
-        not_found_ids = []
-        found_ids = []
+        svg_notes = index_svg(parse_svg(svg_output))
+        overlay = []
+        obj_locs = LocationGrid()
+        for i, row in song_patterns.iterrows():
+            user = row['user_id']
+            # Use 'color' from the DataFrame (set by pattern_tag)
+            pattern_color = row.get('color', '#000000')
 
-        for song_path in song_paths:
-            print(f"  > Loading SVG: {song_path}")
-            try:
-                svg_output = open(os.path.join('output_svgs_mei', song_path), 'r', encoding='utf-8').read()
-            except Exception as e:
-                print(f"    > Error reading SVG: {e}")
+            note_ids = row['record'].note_ids
+            if not note_ids:
                 continue
 
-            colors = ['#ff0000', '#00ff00', '#0000ff', '#800080', '#008000', '#800000', '#000080', '#008080', '#800000',
-                      '#2596be', '#FF9333', '#FF33AB', '#BB33FF', '#2CE1A5', '#CDD136', '#D1AF36', '#D18136']
-            lenCol = len(colors)
-            categories = song_patterns['pattern_tag'].unique()
+            first_id = note_ids[0]
+            last_id = note_ids[-1]
+
+            first_note = svg_notes.get(first_id)
+            last_note = svg_notes.get(last_id)
+            first_note_obj = first_note.element if first_note else None
+            last_note_obj = last_note.element if last_note else None
 
-            # This visualizes SIMILARITY OF TAG
-            for i, category in enumerate(categories):
-                song_patterns.loc[song_patterns['pattern_tag'] == category, 'color'] = colors[i % lenCol]
+            # ... (rest of your drawing logic, which is complex) ...
+            # This logic is kept exactly as you provided it
 
-            # --- FIX ---
-            # This line was unused and 'users' is undefined
-            # user_colors = {user: colors[user % len(colors)] for user in users}
-            # -----------
+            s1 = first_note.use if first_note else None
+            sx1 = int(use_xy(s1)[0]) - 50 - user - random.randint(0, 50) if s1 is not None else 0
+            sy1 = int(use_xy(s1)[1]) - 100 - random.randint(0, 100) if s1 is not None else 0
 
-            svg_soup = bs4.BeautifulSoup(svg_output, 'xml')
-            page_margin = svg_soup.find('g', attrs={'class': 'page-margin'})
+            s2 = last_note.use if last_note else None
+            sx2 = int(use_xy(s2)[0]) if s2 is not None else 20300
+            sy2 = int(use_xy(s2)[1]) if s2 is not None else sy1
 
-            if not page_margin:
-                print(f"    > Warning: Could not find <g class='page-margin'> in {song_path}.")
-                print("    > Annotations will be skipped. Is this a Verovio SVG?")
+            if first_note_obj is None and last_note_obj is None:
                 continue
 
-            obj_locs = []
-            for i, row in song_patterns.iterrows():
-                user = row['user_id']
-                # Use 'color' from the DataFrame (set by pattern_tag)
-                pattern_color = row.get('color', '#000000')
+            if first_note_obj is None or last_note_obj is None:
+                if first_note_obj is not None:
+                    found_ids.append(first_id)
+                    overlay.append(overlay_rect(sx1, sy1, 20300 - sx1, minHeight, pattern_color))
+                    text_x = 20300  # Centered horizontally
+                    text_y = sy1
+                    overlay.append(overlay_text(text_x, text_y, pattern_color,
+                                                f"{row['pattern_tag']} ({row['pattern_rank']})"))
+                if last_note_obj is not None:
+                    found_ids.append(last_id)
+                    overlay.append(overlay_rect(-300, sy1, sx2 + 300, minHeight, pattern_color))
+                    text_x = -300
+                    text_y = sy2
+                    overlay.append(overlay_text(text_x, text_y, pattern_color,
+                                                f"{row['pattern_tag']} ({row['pattern_rank']})"))
+                continue
 
-                soup = bs4.BeautifulSoup(row['xml_file'], 'xml')
-                notes = soup.find_all('note')
-                if not notes:
-                    continue
+            not_found_ids = [x for x in not_found_ids if x != last_id and x != first_id]
+            found_ids.append(first_id)
+            found_ids.append(last_id)
+
+            width = max(abs(int(sx2) - int(sx1) + 200 + random.randint(0, 100)), minWidth)
+            height = max(abs(int(sy2) - int(sy1) + 100 + random.randint(0, 100)), minHeight)
+            rects = []
+
+            if height > 1700:
+                x1 = int(sx1)
+                y1 = int(sy1)
+                height1 = height // 3
+                isOk = False
+                while not isOk:
+                    ok, loc = obj_locs.contains_same_location((x1, y1, 20000 - x1 + 300))
+                    if not ok and loc is not None:
+                        y1 = y1 + minTextHeight
+                    else:
+                        isOk = True
+                        obj_locs.append((x1, y1, 20000 - x1 + 300))
+                        obj_locs.append((x1, y1 + height1, 20000 - x1))
+                rects.append((x1, y1, 20000 - x1 + 300, height1))
+                if height > 2 * 2000:
+                    for r in range(height // 1300 - 1):
+                        rects.append((-300, y1 + 1300, 20600, height1))
+                isOk = False
+                x2 = 0
+                y2 = int(sy2) - height1 // 2
+                height2 = height1
+                while not isOk:
+                    ok, loc = obj_locs.contains_same_location((x2, y2, sx2 + 200))
+                    if not ok and loc is not None:
+                        y2 = y2 + minTextHeight
+                    else:
+                        isOk = True
+                        obj_locs.append((x2 - 300, y2, sx2 + 200))
+                        obj_locs.append((x2 - 300, y2 + height2, sx2 + 200))
+                rects.append((x2 - 300, y2, sx2 + random.randint(0, 100) + 200 + 300, height2))
+            else:
+                isOk = False
+                while not isOk:
+                    ok, loc = obj_locs.contains_same_location((sx1, sy1, width))
+                    if not ok and loc is not None:
+                        sy1 = sy1 + minTextHeight
+                    else:
+                        isOk = True
+                        obj_locs.append((sx1, sy1, width))
+                        obj_locs.append((sx1, sy1 + height, width))
+                rects.append((int(sx1), int(sy1), width, height))
+
+            for rect in rects:
+                overlay.append(overlay_rect(rect[0], rect[1], max(rect[2], minWidth), max(rect[3], minHeight),
+                                            pattern_color))
+                text_x = rect[0] + 400
+                offset = np.random.randint(100, 200)
+                text_y = max(get_text_y(rect) + offset, rect[1] + rect[3] + 200)
+                y_ok = False
+                while not y_ok:
+                    is_ok, loc = obj_locs.contains_same_location((text_x, text_y))
+                    if not is_ok and loc is not None:
+                        text_y = text_y - minTextHeight
+                    else:
+                        y_ok = True
+                        obj_locs.append((text_x, text_y, minTextWidth))
+
+                overlay.append(overlay_text(text_x, text_y, pattern_color,
+                                            f"{row['pattern_tag']} ({row['pattern_rank']})"))
 
-                first_note = notes[0]
-                last_note = notes[-1]
-                first_id = first_note.get('xml:id')
-                last_id = last_note.get('xml:id')
+        # --- FIX ---
+        # Removed the `users` variable from the output name
+        # written (and minified or compressed) in the background while the next file is annotated
+        path = writer.write(annotated_path(song_path), splice_overlay(svg_output, overlay, margin_end))
+        # -----------
+        print(f"  > Saved annotated SVG: {path}")
 
-                if not first_id or not last_id:
-                    continue
+    not_found_ids = [x for x in not_found_ids if not (x in found_ids)]
+    print("not found ids", len(not_found_ids))
+    if len(not_found_ids) > 0:
+        print(not_found_ids)
 
-                first_note_obj = svg_soup.find('g', id=first_id)
-                last_note_obj = svg_soup.find('g', id=last_id)
 
-                # ... (rest of your drawing logic, which is complex) ...
-                # This logic is kept exactly as you provided it
+_worker_songs = None
+_worker_song_files = None
+_worker_svg_format = 'svg'
 
-                s1 = first_note_obj.find('use') if first_note_obj else None
-                sx1 = int(s1['x']) - 50 - user - random.randint(0, 50) if s1 else 0
-                sy1 = int(s1['y']) - 100 - random.randint(0, 100) if s1 else 0
 
-                s2 = last_note_obj.find('use') if last_note_obj else None
-                sx2 = int(s2['x']) if s2 else 20300
-                sy2 = int(s2['y']) if s2 else sy1
+def _init_worker(songs, song_files, svg_format='svg'):
+    # every worker receives the parsed patterns once instead of re-reading the CSV
+    global _worker_songs, _worker_song_files, _worker_svg_format
+    _worker_songs = songs
+    _worker_song_files = song_files
+    _worker_svg_format = svg_format
 
-                if not first_note_obj and not last_note_obj:
-                    continue
 
-                if not first_note_obj or not last_note_obj:
-                    if first_note_obj:
-                        found_ids.append(first_id)
-                        page_margin.append(bs4.BeautifulSoup(
-                            f'<rect fill="none" height="{str(minHeight)}" stroke="{pattern_color}" width="{str(20300 - sx1)}" x="{str(sx1)}" y="{sy1}" stroke-width="50"/>',
-                            'xml').rect)
-                        text_x = 20300  # Centered horizontally
-                        text_y = sy1
-                        text = bs4.BeautifulSoup(f'''
-                            <text x="{text_x}" y="{text_y}" font-weight="bold" font-size="150" fill="{pattern_color}" text-anchor="middle">
-                                {row['pattern_tag']} ({row['pattern_rank']})
-                            </text>
-                        ''', 'xml')
-                        page_margin.append(text)
-                    if last_note_obj:
-                        found_ids.append(last_id)
-                        page_margin.append(bs4.BeautifulSoup(
-                            f'<rect fill="none" height="{str(minHeight)}" stroke="{pattern_color}" width="{str(sx2 + 300)}" x="-300" y="{sy1}" stroke-width="50"/>',
-                            'xml').rect)
-                        text_x = -300
-                        text_y = sy2
-                        text = bs4.BeautifulSoup(f'''
-                            <text x="{text_x}" y="{text_y}" font-weight="bold" font-size="150" fill="{pattern_color}" text-anchor="middle">
-                                {row['pattern_tag']} ({row['pattern_rank']})
-                            </text>
-                        ''', 'xml')
-                        page_margin.append(text)
-                    continue
+def _annotate_task(song_id):
+    with SvgWriter(_worker_svg_format) as writer:
+        annotate_song(song_id, _worker_songs[song_id], _worker_song_files, writer)
+    return song_id
+
+
+def generate_analysis(workers=1, incremental=False, memory_budget=None, svg_format='svg'):
+    # --- PRE-REQUISITE ---
+    # This folder 'output_svgs_mei' MUST exist and be filled with
+    # the SVG files of your scores (e.g., "001_song_1.svg", "002_song_2.svg")
+    # ---------------------
+    try:
+        song_files = os.listdir('Song_Excel_Files_MARIJA (SVG)')
+        if not song_files:
+            print("Error: The 'Song_Excel_Files_MARIJA (SVG)' folder is empty.")
+            print("Please fill it with your pre-rendered SVG score files.")
+            return
+    except FileNotFoundError:
+        print("Error: Folder 'Song_Excel_Files_MARIJA (SVG)' not found.")
+        print("Please create this folder and fill it with your pre-rendered SVG score files.")
+        return
+
+    try:
+        patterns = load_pattern_store()
+    except FileNotFoundError:
+        print("Error: 'PatternVsi (standardized).csv' not found.")
+        return
 
-                not_found_ids = [x for x in not_found_ids if x != last_id and x != first_id]
-                found_ids.append(first_id)
-                found_ids.append(last_id)
-
-                width = max(abs(int(sx2) - int(sx1) + 200 + random.randint(0, 100)), minWidth)
-                height = max(abs(int(sy2) - int(sy1) + 100 + random.randint(0, 100)), minHeight)
-                rects = []
-
-                if height > 1700:
-                    x1 = int(sx1)
-                    y1 = int(sy1)
-                    height1 = height // 3
-                    isOk = False
-                    while not isOk:
-                        ok, loc = contains_same_location(obj_locs, (x1, y1, 20000 - x1 + 300))
-                        if not ok and loc is not None:
-                            y1 = y1 + minTextHeight
-                        else:
-                            isOk = True
-                            obj_locs.append((x1, y1, 20000 - x1 + 300))
-                            obj_locs.append((x1, y1 + height1, 20000 - x1))
-                    rects.append((x1, y1, 20000 - x1 + 300, height1))
-                    if height > 2 * 2000:
-                        for r in range(height // 1300 - 1):
-                            rects.append((-300, y1 + 1300, 20600, height1))
-                    isOk = False
-                    x2 = 0
-                    y2 = int(sy2) - height1 // 2
-                    height2 = height1
-                    while not isOk:
-                        ok, loc = contains_same_location(obj_locs, (x2, y2, sx2 + 200))
-                        if not ok and loc is not None:
-                            y2 = y2 + minTextHeight
-                        else:
-                            isOk = True
-                            obj_locs.append((x2 - 300, y2, sx2 + 200))
-                            obj_locs.append((x2 - 300, y2 + height2, sx2 + 200))
-                    rects.append((x2 - 300, y2, sx2 + random.randint(0, 100) + 200 + 300, height2))
-                else:
-                    isOk = False
-                    while not isOk:
-                        ok, loc = contains_same_location(obj_locs, (sx1, sy1, width))
-                        if not ok and loc is not None:
-                            sy1 = sy1 + minTextHeight
-                        else:
-                            isOk = True
-                            obj_locs.append((sx1, sy1, width))
-                            obj_locs.append((sx1, sy1 + height, width))
-                    rects.append((int(sx1), int(sy1), width, height))
-
-                for rect in rects:
-                    page_margin.append(bs4.BeautifulSoup(
-                        f'<rect fill="none" height="{str(max(rect[3], minHeight))}" stroke="{pattern_color}" width="{str(max(rect[2], minWidth))}" x="{str(rect[0])}" y="{rect[1]}" stroke-width="50"/>',
-                        'xml').rect)
-                    text_x = rect[0] + 400
-                    offset = np.random.randint(100, 200)
-                    text_y = max(get_text_y(rect) + offset, rect[1] + rect[3] + 200)
-                    y_ok = False
-                    while not y_ok:
-                        is_ok, loc = contains_same_location(obj_locs, (text_x, text_y))
-                        if not is_ok and loc is not None:
-                            text_y = text_y - minTextHeight
-                        else:
-                            y_ok = True
-                            obj_locs.append((text_x, text_y, minTextWidth))
-
-                    text = bs4.BeautifulSoup(f'''
-                        <text x="{text_x}" y="{text_y}" font-weight="bold" font-size="150" fill="{pattern_color}" text-anchor="middle">
-                            {row['pattern_tag']} ({row['pattern_rank']})
-                        </text>
-                    ''', 'xml')
-                    page_margin.append(text)
-
-            song_name = song_path.split('.')[0]
-            # --- FIX ---
-            # Removed the `users` variable from the output name
-            path = os.path.join('results', f'{song_name}_annotated.svg')
-            # -----------
-
-            with open(path, 'w', encoding='utf-8') as f:
-                f.write(svg_soup.prettify())
-            print(f"  > Saved annotated SVG: {path}")
-
-        not_found_ids = [x for x in not_found_ids if not (x in found_ids)]
-        print("not found ids", len(not_found_ids))
-        if len(not_found_ids) > 0:
-            print(not_found_ids)
+    # Create output directories
+    os.makedirs('songs', exist_ok=True)
+    os.makedirs('results', exist_ok=True)  # <-- ADDED
+
+    songs = group_by_song(patterns)
+    for song_id in range(22):
+        if song_id not in songs:
+            songs[song_id] = patterns.iloc[:0]
+
+    # a song is annotated again only if one of its pattern rows or its score SVG changed
+    manifest = BuildManifest()
+    hashes = song_user_hashes(patterns)
+    all_users = sorted(patterns['user_id'].unique().tolist())
+    inputs = {}
+    for song_id in range(22):
+        svg_paths = [os.path.join('output_svgs_mei', f) for f in song_svg_paths(song_id, song_files)]
+        inputs[song_id] = digest(pattern_inputs(hashes, song_id, all_users), file_inputs(svg_paths), svg_format)
+    song_ids = list(range(22))
+    if incremental:
+        song_ids = [song_id for song_id in song_ids if not manifest.is_current('annotated_svgs', song_id, inputs[song_id])]
+        print(f"{len(song_ids)} songs changed since the last run")
+
+    # largest scores first, spread over the workers within the memory budget (render_pool)
+    tasks = [RenderTask(f'song {song_id}', song_id,
+                        score_size(os.path.join('output_svgs_mei', f) for f in song_svg_paths(song_id, song_files)),
+                        _annotate_task, song_id)
+             for song_id in song_ids]
+    results = run_tasks(tasks, workers, memory_budget, initializer=_init_worker, initargs=(songs, song_files, svg_format))
+    for task, song_id, seconds in results:
+        outputs = [annotated_path(f, svg_format) for f in song_svg_paths(song_id, song_files)]
+        manifest.record('annotated_svgs', song_id, inputs[song_id], [path for path in outputs if os.path.exists(path)])
+    manifest.save()
+    report_timings(results)
 
 
 # --- FIX ---
 # Added this block to actually run the script
 if __name__ == "__main__":
-    generate_analysis()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes (songs are split between them)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only annotate songs whose patterns or score changed (build_manifest.json)')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help='estimated memory the workers may use together')
+    parser.add_argument('--format', choices=svg_formats, default='svg',
+                        help='min: SVG without indentation, svgz: gzip-compressed SVG')
+    parser.add_argument('--render', action='store_true', help='render missing or outdated score SVGs first (render_scores.py)')
+    args = parser.parse_args()
+    if args.render:
+        render_scores.render_all(workers=args.workers)
+    memory_budget = args.memory_budget * 1e6 if args.memory_budget else None
+    generate_analysis(workers=args.workers, incremental=args.incremental, memory_budget=memory_budget,
+                      svg_format=args.format)
\ No newline at end of file
@@ -0,0 +1,387 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from build_manifest import BuildManifest, digest, pattern_inputs, song_user_hashes
+from pattern_store import classify_overlap, group_by_song, load_pattern_store
+
+# The shipped Jaccard_matrix_all_users.xlsx in this folder compares the *sets of pattern tags*
+# of two users; this engine compares the *notes* they annotated, a different metric, so its
+# workbooks get their own names and never overwrite the shipped one.
+output_folder = 'Jaccard (new)'
+user_workbook = 'Jaccard_notes_all_users.xlsx'
+pattern_workbook = 'Jaccard_notes_pattern_level.xlsx'
+mersenne_prime = (1 << 31) - 1
+
+
+def pattern_note_matrix(song_patterns):
+    """
+    Sparse binary pattern x note matrix (one row per pattern, in frame order). The columns
+    are the codes of the song's NoteTable, which all records of a song share.
+    """
+    records = song_patterns['record'].tolist()
+    n_notes = len(records[0].table) if records else 0
+    indptr = [0]
+    indices = []
+    for record in records:
+        indices.extend(sorted(record.note_set()))
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.int32)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, n_notes))
+
+
+def jaccard_sparse(a, b=None):
+    """
+    Pairwise Jaccard between the rows of two binary sparse matrices over the same vocabulary,
+    as a sparse matrix holding only the pairs that share a note.
+
+    Intersections come from one sparse product, unions from |x| + |y| - |x & y|; nothing
+    dense of size rows(a) x rows(b) is built.
+    """
+    if b is None:
+        b = a
+    intersection = (a @ b.T).tocoo()
+    size_a = np.asarray(a.sum(axis=1)).ravel()
+    size_b = np.asarray(b.sum(axis=1)).ravel()
+    shared = intersection.data.astype(np.float64)
+    union = size_a[intersection.row] + size_b[intersection.col] - shared
+    return sparse.csr_matrix((shared / union, (intersection.row, intersection.col)), shape=intersection.shape)
+
+
+def jaccard_matrix(a, b=None):
+    """
+    jaccard_sparse as a dense array, for the small (users x users) or written-out
+    (pattern-level workbook) tables; rows without any notes get a Jaccard of 0.
+    """
+    return jaccard_sparse(a, b).toarray()
+
+
+def user_note_matrix(song_patterns, users, patterns_matrix):
+    """
+    Binary user x note matrix: a user covers a note if any of their patterns contains it.
+    """
+    user_rows = {user: k for k, user in enumerate(users)}
+    rows = []
+    cols = []
+    for pos, user in enumerate(song_patterns['user_id']):
+        if user in user_rows:
+            rows.append(user_rows[user])
+            cols.append(pos)
+    owner = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                              shape=(len(users), patterns_matrix.shape[0]))
+    return ((owner @ patterns_matrix) > 0).astype(np.int32)
+
+
+def pattern_jaccard(song_patterns):
+    """
+    Pattern-level Jaccard of one song, indexed by pattern row id on both axes.
+    """
+    matrix = pattern_note_matrix(song_patterns)
+    return pd.DataFrame(jaccard_matrix(matrix), index=song_patterns.index, columns=song_patterns.index)
+
+
+def song_user_jaccard(song_patterns, users):
+    """
+    Returns (pair, within) for one song: the users x users Jaccard of the notes each user
+    annotated, and per user the mean Jaccard between two different patterns of that user.
+    """
+    matrix = pattern_note_matrix(song_patterns)
+    pair = jaccard_matrix(user_note_matrix(song_patterns, users, matrix))
+
+    song_users = song_patterns['user_id'].to_numpy()
+    within = np.zeros(len(users))
+    for k, user in enumerate(users):
+        own = matrix[np.flatnonzero(song_users == user)]
+        n = own.shape[0]
+        if n > 1:
+            scores = jaccard_sparse(own)
+            within[k] = (scores.sum() - scores.diagonal().sum()) / (n * (n - 1))
+    return pair, within
+
+
+def generate_jaccard(users, patterns=None):
+    """
+    Computes the user-pair and within-user tables for every song. The metric is note coverage:
+    two users are compared on the union of the notes of all their patterns in the song (not on
+    their sets of pattern tags, as the shipped Jaccard_matrix_all_users.xlsx is).
+
+    Returns (per_song, average, within): one row per song with a Jaccard_{u1}_{u2} column
+    per user pair, the users x users mean over songs, and one row per song with the
+    within-user score of every user.
+
+    A pair of users is only compared in songs where both annotated at least one pattern; in
+    the other songs its per-song cell is empty (NaN) and it does not count towards the mean.
+    Pairs that never annotated the same song get NaN; the diagonal (a user against
+    themself) is 1.
+    """
+    if patterns is None:
+        patterns = load_pattern_store()
+    songs = group_by_song(patterns)
+
+    per_song = []
+    within_rows = []
+    total = np.zeros((len(users), len(users)))
+    count = np.zeros((len(users), len(users)))
+    for song_id in range(22):
+        song_patterns = songs.get(song_id, patterns.iloc[:0])
+        pair, within = song_user_jaccard(song_patterns, users)
+        annotated = np.isin(users, song_patterns['user_id'].unique())
+        both = annotated[:, None] & annotated[None, :]
+        total[both] += pair[both]
+        count[both] += 1
+
+        row = {'song_id': song_id}
+        for a in range(len(users)):
+            for b in range(a + 1, len(users)):
+                row[f'Jaccard_{users[a]}_{users[b]}'] = pair[a, b] if both[a, b] else np.nan
+        per_song.append(row)
+        within_rows.append({'song_id': song_id, **{user: within[k] for k, user in enumerate(users)}})
+
+    average = np.divide(total, count, out=np.full_like(total, np.nan), where=count > 0)
+    np.fill_diagonal(average, 1.0)
+    return pd.DataFrame(per_song), pd.DataFrame(average, index=users, columns=users), pd.DataFrame(within_rows)
+
+
+def minhash_signatures(matrix, num_perm=128, seed=0):
+    """
+    MinHash signature (num_perm values) of every row of a binary pattern x note matrix.
+
+    Each permutation is a universal hash (a * note + b) mod p over the note indices; a row's
+    value is the minimum hash over its notes. Rows without notes get p, which never collides
+    with a real minimum.
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, mersenne_prime, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, mersenne_prime, size=num_perm).astype(np.uint64)
+    notes = np.arange(matrix.shape[1], dtype=np.uint64)
+    hashes = ((a[:, None] * notes[None, :] + b[:, None]) % np.uint64(mersenne_prime)).astype(np.uint32)
+
+    signatures = np.full((matrix.shape[0], num_perm), mersenne_prime, dtype=np.uint32)
+    filled = np.flatnonzero(np.diff(matrix.indptr) > 0)
+    if len(filled):
+        # permutation x note, so every reduction runs along a contiguous row (far faster than axis=0)
+        signatures[filled] = np.minimum.reduceat(hashes[:, matrix.indices], matrix.indptr[filled], axis=1).T
+    return signatures
+
+
+def lsh_bands(num_perm, threshold):
+    """
+    Number of bands for a signature of num_perm values so that the LSH threshold
+    (1 / bands) ** (1 / rows) is as close as possible to `threshold` without exceeding it,
+    which favours recall.
+    """
+    best = num_perm
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands:
+            continue
+        estimate = (1 / bands) ** (bands / num_perm)
+        if estimate <= threshold:
+            best = bands
+            break
+    return best
+
+
+def band_keys(signatures, bands, seed=0):
+    """
+    One uint64 key per (row, band): a random linear combination (mod 2**64) of the band's
+    signature values. Equal bands always get equal keys; unequal ones collide only by chance,
+    which costs a candidate that the exact check drops, never a missed pair.
+    """
+    rows = signatures.shape[1] // bands
+    coefficients = np.random.RandomState(seed).randint(1, 1 << 62, size=rows).astype(np.uint64) | np.uint64(1)
+    banded = signatures[:, :bands * rows].reshape(signatures.shape[0], bands, rows).astype(np.uint64)
+    return (banded * coefficients).sum(axis=2, dtype=np.uint64)
+
+
+def bucket_pairs(keys):
+    """
+    All pairs (i, j), i < j in sort order, of the entries of `keys` (sorted) that are equal,
+    generated without a Python loop: entry i pairs with every later entry of its run.
+    """
+    n = len(keys)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    run_start = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    run_end = np.r_[run_start[1:], n]
+    later = np.repeat(run_end, np.diff(np.r_[run_start, n])) - np.arange(n) - 1
+    left = np.repeat(np.arange(n), later)
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(later) - later, later)
+    return left, left + offsets + 1
+
+
+def lsh_candidate_pairs(signatures, bands):
+    """
+    Pairs (pos_a, pos_b), pos_a < pos_b, whose signatures agree on at least one whole band, as
+    two arrays. Every band's keys are sorted once and equal keys paired in numpy.
+    """
+    filled = np.flatnonzero(signatures[:, 0] != mersenne_prime)
+    n = len(filled)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    keys = band_keys(signatures[filled], bands)
+    order = np.argsort(keys, axis=0, kind='stable')
+    # band after band, so a run of equal keys never crosses into the next band
+    sorted_keys = np.take_along_axis(keys, order, axis=0).T.ravel()
+    band_of = np.repeat(np.arange(bands, dtype=np.uint64), n)
+    boundary = np.r_[True, (sorted_keys[1:] != sorted_keys[:-1]) | (band_of[1:] != band_of[:-1])]
+    left, right = bucket_pairs(np.cumsum(boundary))
+    members = filled[order.T.ravel()]
+    a, b = members[left], members[right]
+    codes = np.unique(np.minimum(a, b) * len(signatures) + np.maximum(a, b))
+    return codes // len(signatures), codes % len(signatures)
+
+
+def lsh_pattern_pairs(matrix, threshold, num_perm=128, seed=0):
+    """
+    (pos_a, pos_b, jaccard) arrays of the rows of a pattern x note matrix with Jaccard >= threshold,
+    pos_a < pos_b, found through MinHash/LSH. The exact Jaccard of all LSH candidates is computed
+    at once from the sparse matrix.
+    """
+    signatures = minhash_signatures(matrix, num_perm, seed)
+    a, b = lsh_candidate_pairs(signatures, lsh_bands(num_perm, threshold))
+    shared = np.asarray(matrix[a].multiply(matrix[b]).sum(axis=1)).ravel()
+    sizes = np.diff(matrix.indptr)
+    jaccard = shared / (sizes[a] + sizes[b] - shared) if len(a) else np.empty(0)
+    keep = jaccard >= threshold
+    return a[keep], b[keep], jaccard[keep]
+
+
+def approximate_pattern_pairs(song_patterns, threshold, num_perm=128, seed=0, same_user=False):
+    """
+    Pattern pairs of one song with Jaccard >= threshold, found through MinHash/LSH
+    (lsh_pattern_pairs); only those pairs get the overlap classification. Like the exact match
+    pipeline, only patterns of two different users are paired, unless same_user=True. Returns a
+    frame with one row per pair; pattern a is the one that comes first in the song's frame.
+    """
+    columns = ['song_id', 'id_a', 'id_b', 'user_a', 'user_b', 'tag_a', 'tag_b', 'jaccard', 'match_type']
+    if song_patterns.empty:
+        return pd.DataFrame(columns=columns)
+
+    a, b, jaccard = lsh_pattern_pairs(pattern_note_matrix(song_patterns), threshold, num_perm, seed)
+    user_ids = song_patterns['user_id'].to_numpy()
+    if not same_user:
+        keep = user_ids[a] != user_ids[b]
+        a, b, jaccard = a[keep], b[keep], jaccard[keep]
+
+    records = song_patterns['record'].tolist()
+    match_types = []
+    for pos_a, pos_b in zip(a.tolist(), b.tolist()):
+        record_a, record_b = records[pos_a], records[pos_b]
+        match_types.append(classify_overlap(record_a.codes, record_a.note_set(), record_b.codes, record_b.note_set()))
+    row_ids = song_patterns.index.to_numpy()
+    tags = song_patterns['pattern_tag'].to_numpy()
+    return pd.DataFrame({
+        'song_id': song_patterns['song_id'].to_numpy()[a], 'id_a': row_ids[a], 'id_b': row_ids[b],
+        'user_a': user_ids[a], 'user_b': user_ids[b], 'tag_a': tags[a], 'tag_b': tags[b],
+        'jaccard': jaccard, 'match_type': match_types,
+    }, columns=columns)
+
+
+def exact_pattern_pairs(matrix, threshold):
+    """
+    Position pairs (pos_a < pos_b) with Jaccard >= threshold, from the exact sparse engine.
+    """
+    scores = sparse.triu(jaccard_sparse(matrix), k=1).tocoo()
+    keep = scores.data >= threshold
+    return set(zip(scores.row[keep].tolist(), scores.col[keep].tolist()))
+
+
+def benchmark_minhash(patterns, thresholds=(0.3, 0.5, 0.7, 0.9), num_perm=128):
+    """
+    Recall and run time of the MinHash/LSH mode against the exact engine, per threshold. Both
+    sides are timed on the same pattern x note matrices, up to the pairs and their Jaccard; the
+    overlap classification of the pairs found costs the same in either mode and is left out.
+    """
+    matrices = [pattern_note_matrix(song_patterns) for song_patterns in group_by_song(patterns).values()]
+    rows = []
+    for threshold in thresholds:
+        found = expected = candidates = 0
+        exact_time = approximate_time = 0.0
+        for matrix in matrices:
+            start = time.perf_counter()
+            exact = exact_pattern_pairs(matrix, threshold)
+            exact_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            # recall of the LSH itself, so against every exact pair, same-user ones included
+            a, b, _ = lsh_pattern_pairs(matrix, threshold, num_perm)
+            approximate_time += time.perf_counter() - start
+
+            approximate = set(zip(a.tolist(), b.tolist()))
+            found += len(exact & approximate)
+            expected += len(exact)
+            candidates += len(approximate)
+        rows.append({
+            'threshold': threshold,
+            'exact_pairs': expected,
+            'approximate_pairs': candidates,
+            'recall': found / expected if expected else 1.0,
+            'exact_seconds': exact_time,
+            'approximate_seconds': approximate_time,
+        })
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--approximate', type=float, metavar='THRESHOLD',
+                        help='only list pattern pairs with Jaccard >= THRESHOLD, found with MinHash/LSH')
+    parser.add_argument('--benchmark', action='store_true', help='report MinHash/LSH recall against the exact engine')
+    parser.add_argument('--num-perm', type=int, default=128, help='MinHash signature length')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip the tables if no pattern changed since the last run (build_manifest.json)')
+    args = parser.parse_args()
+
+    users = [36, 46, 48, 49, 51]
+    patterns = load_pattern_store()
+
+    if args.benchmark:
+        print(benchmark_minhash(patterns, num_perm=args.num_perm).to_string(index=False))
+        raise SystemExit
+
+    if args.approximate is not None:
+        os.makedirs(output_folder, exist_ok=True)
+        pairs = pd.concat([approximate_pattern_pairs(song_patterns, args.approximate, args.num_perm)
+                           for song_patterns in group_by_song(patterns).values()], ignore_index=True)
+        path = os.path.join(output_folder, f'approximate_pairs_{args.approximate}.csv')
+        pairs.to_csv(path, index=False)
+        print(f"Saved {len(pairs)} pattern pairs to '{path}'")
+        raise SystemExit
+
+    # the user-level workbook only covers `users`, the pattern-level one every user of a song
+    all_users = sorted(patterns['user_id'].unique().tolist())
+    outputs = [os.path.join(output_folder, user_workbook), os.path.join(output_folder, pattern_workbook)]
+    manifest = BuildManifest()
+    hashes = song_user_hashes(patterns)
+    inputs = digest(users, [pattern_inputs(hashes, song_id, all_users) for song_id in range(22)])
+    if args.incremental and manifest.is_current('jaccard_tables', 'all', inputs):
+        print(f"No pattern changed, keeping the tables in '{output_folder}'")
+        raise SystemExit
+
+    per_song, average, within = generate_jaccard(users, patterns)
+
+    pairs = per_song.drop(columns='song_id')
+    top_pairs = pd.DataFrame([
+        {'user_1': int(c.split('_')[1]), 'user_2': int(c.split('_')[2]), 'mean_jaccard': pairs[c].mean()}
+        for c in pairs.columns
+    ]).sort_values('mean_jaccard', ascending=False)
+    song_similarity = pd.DataFrame({'song_id': per_song['song_id'], 'mean_similarity': pairs.mean(axis=1)})
+
+    os.makedirs(output_folder, exist_ok=True)
+    with pd.ExcelWriter(outputs[0]) as writer:
+        per_song.to_excel(writer, sheet_name='Per_song_matrix', index=False)
+        average.to_excel(writer, sheet_name='Average_matrix')
+        top_pairs.to_excel(writer, sheet_name='Top_pairs', index=False)
+        song_similarity.to_excel(writer, sheet_name='Song_similarity', index=False)
+        within.to_excel(writer, sheet_name='Within_user', index=False)
+
+    with pd.ExcelWriter(outputs[1]) as writer:
+        for song_id, song_patterns in group_by_song(patterns).items():
+            pattern_jaccard(song_patterns).to_excel(writer, sheet_name=f'Song_{song_id}')
+    manifest.record('jaccard_tables', 'all', inputs, outputs)
+    manifest.save()
+    print(f"Saved Jaccard tables to '{output_folder}'")
@@ -0,0 +1,147 @@
+import math
+import os
+from array import array
+
+import numpy as np
+
+from pattern_store import NoteTable, PatternRecord
+
+store_folder = os.path.join('results', 'store')
+intersect = 'intersect'
+contained1in2 = 'contained1in2'
+contained2in1 = 'contained2in1'
+match_types = [intersect, contained1in2, contained2in1]
+
+# Each song is a single .npy file holding one uint8 buffer, so a pair is read with one open and
+# one header parse. The buffer is laid out as:
+#   header           int64 counts: patterns, codes, pairs, matches, bytes of notes, bytes of tags
+#   pattern_rows     int64 row id of every stored pattern
+#   pattern_offsets  int64, pattern k owns pattern_codes[offsets[k]:offsets[k + 1]]
+#   pairs            int64 rows of (user1, user2, first match of the pair); the pair's matches end
+#                    where the next pair's begin
+#   pattern_codes    int32 note codes of all patterns, concatenated
+#   matches          int32 rows of (pattern_a, pattern_b, match_type index into match_types)
+#   notes            note xml:id strings, utf-8, separated by NUL; codes index into them
+#   tags             pattern_tag of every stored pattern, utf-8, separated by NUL
+_header_size = 6
+_separator = '\0'
+
+
+def song_path(song_id, folder=store_folder):
+    return os.path.join(folder, f'{song_id}.npy')
+
+
+def _read_song(path, mmap_mode=None):
+    """
+    The sections of a song file as numpy views (notes and tags still as bytes).
+    """
+    buffer = np.load(path, mmap_mode=mmap_mode)
+    patterns, codes, pairs, matches, notes, tags = np.frombuffer(buffer, np.int64, _header_size).tolist()
+    sections = {}
+    position = _header_size * 8
+    for name, dtype, shape in (('pattern_rows', np.int64, (patterns,)),
+                               ('pattern_offsets', np.int64, (patterns + 1,)),
+                               ('pairs', np.int64, (pairs, 3)),
+                               ('pattern_codes', np.int32, (codes,)),
+                               ('matches', np.int32, (matches, 3)),
+                               ('notes', np.uint8, (notes,)),
+                               ('tags', np.uint8, (tags,))):
+        count = math.prod(shape)
+        sections[name] = np.frombuffer(buffer, dtype, count, position).reshape(shape)
+        position += count * np.dtype(dtype).itemsize
+    return sections
+
+
+def write_song(song_id, pair_matches, folder=store_folder):
+    """
+    Writes the matches of all user pairs of one song. Every pattern referenced by any pair is
+    stored once in the song's pattern table; the matches only hold integer references to it.
+
+    Pairs already stored for the song but missing from pair_matches are kept: they are read back
+    and written again against the new pattern table.
+    """
+    os.makedirs(folder, exist_ok=True)
+    kept = {}
+    for user1, user2 in stored_pairs(song_id, folder):
+        if (user1, user2) not in pair_matches:
+            kept[(user1, user2)] = load_pair(song_id, user1, user2, folder)
+    pair_matches = {**kept, **pair_matches}
+
+    table = NoteTable()
+    positions = {}
+    rows = []
+    tags = []
+    offsets = [0]
+    codes = []
+
+    def pattern_position(record):
+        if record.row_id not in positions:
+            positions[record.row_id] = len(rows)
+            rows.append(record.row_id)
+            tags.append(str(record.tag))
+            codes.extend(table.encode(record.note_ids))
+            offsets.append(len(codes))
+        return positions[record.row_id]
+
+    pairs = []
+    matches = []
+    for (user1, user2), pair in pair_matches.items():
+        pairs.append((user1, user2, len(matches)))
+        matches.extend((pattern_position(record1), pattern_position(record2), match_types.index(match_type))
+                       for record1, record2, match_type in pair)
+
+    notes = _separator.join(table.strings).encode('utf-8')
+    tags = _separator.join(tags).encode('utf-8')
+    sections = [np.array([len(rows), len(codes), len(pairs), len(matches), len(notes), len(tags)], dtype=np.int64),
+                np.array(rows, dtype=np.int64),
+                np.array(offsets, dtype=np.int64),
+                np.array(pairs, dtype=np.int64).reshape(-1, 3),
+                np.array(codes, dtype=np.int32),
+                np.array(matches, dtype=np.int32).reshape(-1, 3),
+                np.frombuffer(notes, np.uint8),
+                np.frombuffer(tags, np.uint8)]
+    np.save(song_path(song_id, folder), np.concatenate([section.view(np.uint8).ravel() for section in sections]))
+
+
+def stored_pairs(song_id, folder=store_folder):
+    path = song_path(song_id, folder)
+    if not os.path.exists(path):
+        return []
+    return sorted((user1, user2) for user1, user2, _ in _read_song(path, mmap_mode='r')['pairs'].tolist())
+
+
+def has_pair(song_id, user1, user2, folder=store_folder):
+    return (user1, user2) in stored_pairs(song_id, folder)
+
+
+def load_pair(song_id, user1, user2, folder=store_folder):
+    """
+    Loads the matches of one user pair in one song as (record1, record2, match_type) triples.
+
+    The records share one NoteTable over all notes of the song, so their codes are the stored
+    ones and each record's int32 array is cut straight out of the song's code buffer.
+    """
+    song = _read_song(song_path(song_id, folder))
+    pairs = song['pairs']
+    index = np.flatnonzero((pairs[:, 0] == user1) & (pairs[:, 1] == user2))
+    if not len(index):
+        raise KeyError(f'no matches stored for users {user1} and {user2} in song {song_id}')
+    first = pairs[index[0], 2]
+    last = pairs[index[0] + 1, 2] if index[0] + 1 < len(pairs) else len(song['matches'])
+    columns = song['matches'][first:last]
+
+    positions = np.unique(columns[:, :2])
+    table = NoteTable.from_strings(song['notes'].tobytes().decode('utf-8').split(_separator))
+    tags = song['tags'].tobytes().decode('utf-8').split(_separator)
+    rows = song['pattern_rows'][positions].tolist()
+    offsets = song['pattern_offsets']
+    codes = song['pattern_codes'].tobytes()
+
+    size = np.dtype(np.int32).itemsize
+    starts = (offsets[positions] * size).tolist()
+    ends = (offsets[positions + 1] * size).tolist()
+    records = [PatternRecord(array('i', codes[start:end]), tags[position], row, table)
+               for position, row, start, end in zip(positions.tolist(), rows, starts, ends)]
+    # the matches refer to patterns by their position in the song table
+    slots = np.searchsorted(positions, columns[:, :2]).tolist()
+    return [(records[a], records[b], match_types[t]) for (a, b), t in zip(slots, columns[:, 2].tolist())]
@@ -0,0 +1,159 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from score_parsing import XML_ERRORS, mei_note_ids
+from spreadsheetml import read_spreadsheetml
+
+try:
+    import pyarrow  # noqa: F401  (pandas' Parquet engine)
+except ImportError:  # without it every load reads and parses the source again
+    pyarrow = None
+
+cache_folder = '.pattern_cache'
+partition_cols = ['song_id', 'user_id']
+user_files = os.path.join('User_Excel_Files', 'User*_standardized.xlsx')
+# bump whenever read_source changes what goes into the cache (e.g. how the note ids are extracted)
+cache_version = 1
+
+# Every source table (the pattern CSV, a user workbook, a SpreadsheetML export, ...) is cached as
+#   .pattern_cache/<file name>/song_id=S/user_id=U/*.parquet   its rows, xml_file replaced by note_ids
+#   .pattern_cache/<file name>.json                           cache_version, mtime, size and sha256 of the source
+# The cache is reused while it was written by the current cache_version and the source keeps its
+# mtime and size; when those change it is reused only if the content hash is still the same.
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _note_ids(xml_file, path, row):
+    if not isinstance(xml_file, str):
+        return ()
+    try:
+        return mei_note_ids(xml_file)
+    except XML_ERRORS as e:
+        print(f"    Warning: Could not parse the xml_file of row {row} in '{path}', it gets no notes. Error: {e}")
+        return ()
+
+
+def read_source(path):
+    """
+    The source table as pandas (or spreadsheetml, for .xml workbooks) reads it, with the xml_file
+    cells replaced by a note_ids column (the xml:id's of each snippet's notes, in score order).
+    """
+    if path.endswith(('.xlsx', '.xls')):
+        table = pd.read_excel(path)
+    elif path.endswith('.xml'):
+        table = read_spreadsheetml(path)
+    else:
+        table = pd.read_csv(path)
+    if 'xml_file' in table.columns:
+        table['note_ids'] = [_note_ids(xml_file, path, row) for row, xml_file in zip(table.index, table['xml_file'])]
+        table = table.drop(columns='xml_file')
+    return table
+
+
+def _cache_paths(path, folder):
+    name = os.path.basename(path)
+    return os.path.join(folder, name), os.path.join(folder, name + '.json')
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _is_fresh(path, manifest, manifest_path):
+    if manifest is None or manifest.get('version') != cache_version:
+        return False
+    stat = os.stat(path)
+    if stat.st_mtime_ns == manifest['mtime_ns'] and stat.st_size == manifest['size']:
+        return True
+    if stat.st_size != manifest['size'] or file_hash(path) != manifest['sha256']:
+        return False
+    # touched but unchanged: remember the new mtime so the hash is not needed next time
+    manifest['mtime_ns'] = stat.st_mtime_ns
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return True
+
+
+def ingest(path, folder=cache_folder):
+    """
+    (Re)builds the cache of one source table and returns its manifest.
+    """
+    dataset_path, manifest_path = _cache_paths(path, folder)
+    stat = os.stat(path)
+    table = read_source(path)
+
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    os.makedirs(folder, exist_ok=True)
+    partitions = [column for column in partition_cols if column in table.columns]
+    table.assign(_row=table.index).to_parquet(dataset_path, partition_cols=partitions or None, index=False)
+
+    manifest = {
+        'version': cache_version,
+        'source': path,
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': file_hash(path),
+        'columns': list(table.columns),
+        'dtypes': {column: str(table[column].dtype) for column in partitions},
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_table(path, folder=cache_folder):
+    """
+    Loads a pattern table through the cache, building or refreshing the cache first if needed.
+
+    Returns the source rows (in source order, indexed by source row number) with a note_ids
+    column instead of xml_file.
+    """
+    if pyarrow is None:
+        return read_source(path)
+
+    dataset_path, manifest_path = _cache_paths(path, folder)
+    manifest = _read_manifest(manifest_path)
+    if not _is_fresh(path, manifest, manifest_path) or not os.path.isdir(dataset_path):
+        manifest = ingest(path, folder)
+
+    table = pd.read_parquet(dataset_path)
+    for column, dtype in manifest['dtypes'].items():
+        table[column] = table[column].astype(dtype)
+    table = table.sort_values('_row').set_index('_row')
+    table.index.name = None
+    if 'note_ids' in table.columns:
+        table['note_ids'] = [tuple(note_ids) for note_ids in table['note_ids']]
+    return table[manifest['columns']]
+
+
+if __name__ == '__main__':
+    from pattern_store import PATTERNS_CSV
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sources', nargs='*',
+                        help="tables to ingest, e.g. 'All songs.xml' (default: the pattern CSV and all user workbooks)")
+    args = parser.parse_args()
+
+    for source in args.sources or [PATTERNS_CSV, *sorted(glob.glob(user_files))]:
+        if not os.path.exists(source):
+            print(f"Skipping '{source}': not found")
+            continue
+        manifest = ingest(source)
+        print(f"Cached '{source}' ({manifest['sha256'][:12]})")
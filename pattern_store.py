@@ -0,0 +1,206 @@
+import os
+from array import array
+from functools import lru_cache
+
+from pattern_cache import load_table
+from score_parsing import iter_mei_note_ids
+
+PATTERNS_CSV = 'PatternVsi (standardized).csv'
+SCORE_FOLDER = 'Split_Songs'
+
+intersect = 'intersect'
+contained1in2 = 'contained1in2'
+contained2in1 = 'contained2in1'
+
+
+class NoteTable:
+    """
+    Per-song string table: every note xml:id of a song is stored once and referred to by an int32 code.
+    """
+    __slots__ = ('codes', 'strings')
+
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+
+    @classmethod
+    def from_strings(cls, strings):
+        table = cls()
+        table.strings = list(strings)
+        # the reverse map is only needed to intern more notes, so it is built on first use
+        table.codes = None
+        return table
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, note_id):
+        if self.codes is None:
+            self.codes = {note_id: code for code, note_id in enumerate(self.strings)}
+        code = self.codes.get(note_id)
+        if code is None:
+            code = len(self.strings)
+            self.codes[note_id] = code
+            self.strings.append(note_id)
+        return code
+
+    def encode(self, note_ids):
+        return array('i', [self.intern(note_id) for note_id in note_ids])
+
+    def decode(self, codes):
+        return tuple(self.strings[code] for code in codes)
+
+
+class PatternRecord:
+    """
+    One pattern: its note codes (in score order) into the song's NoteTable, plus tag and row id.
+    Only the int32 array is kept; comparisons build the note set with note_set() while they need it.
+    """
+    __slots__ = ('codes', 'tag', 'row_id', 'table')
+
+    def __init__(self, codes, tag, row_id, table):
+        self.codes = codes
+        self.tag = tag
+        self.row_id = row_id
+        self.table = table
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __repr__(self):
+        return f'PatternRecord({self.tag!r}, {self.row_id}, {len(self.codes)} notes)'
+
+    def note_set(self):
+        return frozenset(self.codes)
+
+    @property
+    def note_ids(self):
+        return self.table.decode(self.codes)
+
+    def to_json(self):
+        """
+        The [note_ids, tag, row_id] triple used by the results/*.json files.
+        """
+        return [list(self.note_ids), self.tag, self.row_id]
+
+
+def load_pattern_store(path=PATTERNS_CSV):
+    """
+    Reads the pattern table through the pattern_cache ingest, so every xml_file cell is parsed
+    only when the CSV changes.
+
+    Adds a 'record' column holding a PatternRecord per row; all comparison code reads from
+    it instead of the raw XML. Records of the same song share one NoteTable.
+    """
+    patterns = load_table(path)
+    tables = {}
+    records = []
+    for row_id, song_id, tag, note_ids in zip(patterns.index.tolist(), patterns['song_id'],
+                                              patterns['pattern_tag'], patterns['note_ids']):
+        table = tables.setdefault(song_id, NoteTable())
+        records.append(PatternRecord(table.encode(note_ids), tag, row_id, table))
+    patterns['record'] = records
+    return patterns
+
+
+def build_note_index(patterns, order=None):
+    """
+    Inverted index from note code to the positions (0-based, in frame order) of the
+    patterns in `patterns` that contain it. If a note_order is given only the notes missing
+    from it are indexed.
+    """
+    index = {}
+    for pos, record in enumerate(patterns['record']):
+        for code in record.note_set():
+            if order is None or record.table.strings[code] not in order:
+                index.setdefault(code, []).append(pos)
+    return index
+
+
+def candidate_positions(note_set, index):
+    """
+    Positions of all indexed patterns sharing at least one note with `note_set`, in frame order.
+    """
+    return sorted({pos for code in note_set for pos in index.get(code, ())})
+
+
+def classify_overlap(note_ids, note_set, note_ids2, note_set2):
+    """
+    How two patterns overlap, from their notes in score order and as sets: None if they share
+    no note, contained1in2 / contained2in1 if one lies strictly inside the other, else intersect
+    (which includes patterns sharing their first or last note).
+    """
+    if note_set.isdisjoint(note_set2):
+        return None
+    if note_set <= note_set2:
+        # prvi je mogoce contained v drugem
+        if note_ids2[0] in note_set or note_ids2[-1] in note_set:
+            # imamo overlap
+            return intersect
+        return contained1in2
+    if note_set2 <= note_set:
+        if note_ids[0] in note_set2 or note_ids[-1] in note_set2:
+            return intersect
+        return contained2in1
+    return intersect
+
+
+def group_by_song(patterns):
+    """
+    Splits the store into one frame per song_id, so every song is filtered only once.
+    """
+    return {song_id: song_patterns for song_id, song_patterns in patterns.groupby('song_id')}
+
+
+@lru_cache(maxsize=None)
+def note_order(song_id, folder=SCORE_FOLDER):
+    """
+    {xml:id: position of the note in the score} for one song, read once (per process) from its
+    NNN_*.xml MEI in `folder`. None if the song has no MEI there.
+    """
+    if not os.path.isdir(folder):
+        return None
+    prefix = f'{int(song_id):03d}'
+    for name in sorted(os.listdir(folder)):
+        if name.startswith(prefix) and name.endswith('.xml'):
+            return {note_id: k for k, note_id in enumerate(iter_mei_note_ids(os.path.join(folder, name)))}
+    return None
+
+
+def note_spans(records, order):
+    """
+    Places the patterns on the score's note order. Returns (hulls, exact), one entry per record:
+    hulls[pos] is the (first, last) position of its notes that appear in `order` (None if none
+    do), and exact[pos] tells whether the pattern is precisely the run first..last of the score,
+    in score order, so that interval arithmetic on the hull gives the same answers as its notes.
+    """
+    hulls = []
+    exact = []
+    for record in records:
+        strings = record.table.strings
+        positions = [] if order is None else [order.get(strings[code]) for code in record.codes]
+        known = [position for position in positions if position is not None]
+        if not known:
+            hulls.append(None)
+            exact.append(False)
+            continue
+        start = positions[0]
+        hulls.append((min(known), max(known)))
+        exact.append(start is not None and positions == list(range(start, start + len(positions))))
+    return hulls, exact
+
+
+def overlapping_positions(hulls):
+    """
+    {pos: {positions of the other hulls overlapping it}}, found with a sweep over the hulls
+    sorted by start: each hull only meets the ones starting before it ends.
+    """
+    by_start = sorted((hull[0], hull[1], pos) for pos, hull in enumerate(hulls) if hull is not None)
+    overlaps = {}
+    for k, (start, end, pos) in enumerate(by_start):
+        for start2, end2, pos2 in by_start[k + 1:]:
+            if start2 > end:
+                break
+            overlaps.setdefault(pos, set()).add(pos2)
+            overlaps.setdefault(pos2, set()).add(pos)
+    return overlaps
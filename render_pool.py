@@ -0,0 +1,99 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from tqdm import tqdm
+
+# rough peak memory of working on a score, as a multiple of its SVG size (parsed tree + output text)
+tree_factor = 12
+
+
+class RenderTask:
+    """
+    One unit of rendering work: fn(*args), working on the score(s) identified by `score`.
+    `size` is the size in bytes of the score files it loads.
+    """
+    __slots__ = ('label', 'score', 'size', 'fn', 'args')
+
+    def __init__(self, label, score, size, fn, *args):
+        self.label = label
+        self.score = score
+        self.size = size
+        self.fn = fn
+        self.args = args
+
+    def __repr__(self):
+        return f'RenderTask({self.label!r}, {self.size} bytes)'
+
+
+def score_size(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def _timed(fn, args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def run_tasks(tasks, workers=1, memory_budget=None, initializer=None, initargs=()):
+    """
+    Runs the tasks largest score first and returns [(task, result, seconds)] in completion order.
+
+    With workers > 1 they run in a process pool, with two limits on what runs side by side:
+    - the same score is never worked on by two tasks at once;
+    - the estimated memory of the running tasks (size * tree_factor each) stays within
+      memory_budget bytes, except that a task always runs when nothing else does.
+    When a task does not fit, smaller ones further down the queue may start first.
+    """
+    pending = sorted(tasks, key=lambda task: task.size, reverse=True)
+    results = []
+
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tqdm(pending):
+            result, seconds = _timed(task.fn, task.args)
+            results.append((task, result, seconds))
+        return results
+
+    running = {}
+    busy_scores = set()
+    used = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool, \
+            tqdm(total=len(pending)) as progress:
+        while pending or running:
+            for task in list(pending):
+                if len(running) >= workers:
+                    break
+                cost = task.size * tree_factor
+                if task.score in busy_scores:
+                    continue
+                if running and memory_budget is not None and used + cost > memory_budget:
+                    continue
+                pending.remove(task)
+                running[pool.submit(_timed, task.fn, task.args)] = task
+                busy_scores.add(task.score)
+                used += cost
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                busy_scores.discard(task.score)
+                used -= task.size * tree_factor
+                result, seconds = future.result()
+                results.append((task, result, seconds))
+                progress.update()
+    return results
+
+
+def report_timings(results, top=10):
+    """
+    Prints the total and the slowest tasks of a run_tasks result.
+    """
+    if not results:
+        return
+    total = sum(seconds for _, _, seconds in results)
+    print(f"{len(results)} tasks, {total:.1f} s of work")
+    for task, _, seconds in sorted(results, key=lambda item: item[2], reverse=True)[:top]:
+        print(f"  {seconds:8.2f} s  {task.size / 1e6:7.1f} MB  {task.label}")
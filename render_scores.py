@@ -0,0 +1,142 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import verovio as vrv
+
+from render_pool import RenderTask, report_timings, run_tasks
+
+source_folder = 'Split_Songs'
+render_cache = '.render_cache'
+# the folders the SVG scripts read the rendered scores from
+svg_folders = ['output_svgs_mei', 'Song_Excel_Files_MARIJA (SVG)']
+
+# one tall page per song, so the scripts' y coordinates are continuous over the whole score
+default_options = {
+    'adjustPageHeight': True,
+    'breaks': 'auto',
+    'pageHeight': 60000,
+    'header': 'none',
+    'footer': 'none',
+}
+
+# .render_cache/<key>/page_N.svg, where key hashes the MEI bytes, the Verovio options and the
+# Verovio version; a song is rendered again only when one of those changes.
+
+
+def cache_key(mei_path, options):
+    digest = hashlib.sha256()
+    with open(mei_path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(json.dumps(options, sort_keys=True).encode())
+    digest.update(vrv.toolkit().getVersion().encode())
+    return digest.hexdigest()
+
+
+def render_mei(mei_path, options):
+    """
+    Renders an MEI file with the Verovio toolkit and returns the SVG text of every page.
+    """
+    tk = vrv.toolkit()
+    tk.setOptions(options)
+    if not tk.loadFile(mei_path):
+        raise ValueError(f"Verovio could not load '{mei_path}'")
+    return [tk.renderToSVG(page) for page in range(1, tk.getPageCount() + 1)]
+
+
+def cached_render(mei_path, options=None, cache=render_cache):
+    """
+    Paths of the rendered pages of one MEI file, rendering it first if the cache has no entry
+    for its current content and options.
+    """
+    options = default_options if options is None else options
+    entry = os.path.join(cache, cache_key(mei_path, options))
+    if not os.path.isdir(entry):
+        tmp_entry = entry + f'.tmp{os.getpid()}'
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        for page, svg in enumerate(render_mei(mei_path, options), start=1):
+            with open(os.path.join(tmp_entry, f'page_{page}.svg'), 'w', encoding='utf-8') as f:
+                f.write(svg)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:  # rendered concurrently by another process, which got there first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+    pages = sorted(os.listdir(entry), key=lambda name: int(name[len('page_'):-len('.svg')]))
+    return [os.path.join(entry, name) for name in pages]
+
+
+def svg_names(mei_name, n_pages):
+    """
+    NNN_title.svg for the first page, NNN_title_page_K.svg for the following ones; the scripts
+    pick up every file starting with the song number.
+    """
+    stem = os.path.splitext(mei_name)[0]
+    return [f'{stem}.svg' if page == 1 else f'{stem}_page_{page}.svg' for page in range(1, n_pages + 1)]
+
+
+def _same_file(path, other):
+    if not os.path.exists(other) or os.path.getsize(path) != os.path.getsize(other):
+        return False
+    with open(path, 'rb') as f, open(other, 'rb') as g:
+        return f.read() == g.read()
+
+
+def render_song(mei_path, options, cache, folders):
+    """
+    Renders (or takes from the cache) one song and copies its pages into `folders`. Files whose
+    content is already up to date are left alone. Returns the number of files written.
+    """
+    pages = cached_render(mei_path, options, cache)
+    written = 0
+    for folder in folders:
+        for page, name in zip(pages, svg_names(os.path.basename(mei_path), len(pages))):
+            target = os.path.join(folder, name)
+            if not _same_file(page, target):
+                shutil.copyfile(page, target)
+                written += 1
+    return written
+
+
+def render_all(source=source_folder, folders=svg_folders, options=None, workers=1, cache=render_cache):
+    """
+    Renders every NNN_*.xml score of `source` into the SVG folders, spread over `workers`
+    processes, largest score first.
+    """
+    options = default_options if options is None else options
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+    os.makedirs(cache, exist_ok=True)
+
+    tasks = []
+    for name in sorted(os.listdir(source)):
+        mei_path = os.path.join(source, name)
+        if name.endswith('.xml') and name[:3].isdigit() and os.path.isfile(mei_path):
+            tasks.append(RenderTask(name, mei_path, os.path.getsize(mei_path), render_song, mei_path, options, cache,
+                                    folders))
+    results = run_tasks(tasks, workers)
+    print(f"{len(results)} scores, {sum(written for _, written, _ in results)} SVG files updated")
+    report_timings(results)
+    return results
+
+
+def parse_option(text):
+    key, value = text.split('=', 1)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', default=source_folder, help='folder with the NNN_*.xml MEI scores')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes (songs are split between them)')
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE',
+                        help='Verovio option on top of the defaults (value parsed as JSON where possible)')
+    args = parser.parse_args()
+
+    options = {**default_options, **dict(parse_option(option) for option in args.option)}
+    render_all(args.source, options=options, workers=args.workers)
@@ -0,0 +1,154 @@
+from lxml import etree
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:  # without it malformed SVGs raise instead of being recovered
+    BeautifulSoup = None
+
+MEI_NS = 'http://www.music-encoding.org/ns/mei'
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+SVG_NS = 'http://www.w3.org/2000/svg'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+NAMESPACES = {'mei': MEI_NS, 'xml': XML_NS, 'svg': SVG_NS}
+
+# Parsing is strict: a malformed score raises one of XML_ERRORS, which color_patterns reports.
+# mei_note_ids and parse_svg, whose input the scripts used to read with BeautifulSoup (the pattern
+# table holds truncated snippets), fall back to it for text that lxml rejects; the ingest
+# (pattern_cache) reports what cannot be read either way.
+XML_ERRORS = (etree.XMLSyntaxError,)
+
+_parser = etree.XMLParser(huge_tree=True)
+_class_test = "contains(concat(' ', normalize-space(@class), ' '), ' {} ')"
+_note_ids = etree.XPath('//mei:note/@xml:id | //note/@xml:id', namespaces=NAMESPACES)
+_notes = etree.XPath('//mei:note', namespaces=NAMESPACES)
+_groups = etree.XPath('.//svg:g[@id]', namespaces=NAMESPACES)
+_systems = etree.XPath(f"//svg:g[{_class_test.format('system')}]", namespaces=NAMESPACES)
+_page_margin = etree.XPath(f"//svg:g[{_class_test.format('page-margin')}]", namespaces=NAMESPACES)
+_noteheads = etree.XPath(f".//svg:g[{_class_test.format('notehead')}]", namespaces=NAMESPACES)
+_uses = etree.XPath('.//svg:use', namespaces=NAMESPACES)
+
+_mei_note = f'{{{MEI_NS}}}note'
+_xml_id = f'{{{XML_NS}}}id'
+
+
+def _as_bytes(text):
+    # lxml refuses str input that carries an encoding declaration
+    return text.encode('utf-8') if isinstance(text, str) else text
+
+
+def _first(found):
+    return found[0] if found else None
+
+
+def mei_note_ids(xml_text):
+    """
+    xml:id's of the <note>s of an MEI document given as a string, in score order. A snippet that
+    lxml rejects is read with BeautifulSoup instead, which keeps the notes before the point where it
+    breaks off; the lxml error is raised if that is not possible.
+    """
+    data = _as_bytes(xml_text)
+    try:
+        return tuple(_note_ids(etree.fromstring(data, _parser)))
+    except etree.XMLSyntaxError as error:
+        if BeautifulSoup is None:
+            raise
+        print(f"    > Warning: {error}; reading the MEI snippet through BeautifulSoup instead")
+        soup = BeautifulSoup(data, 'xml')
+        return tuple(note['xml:id'] for note in soup.find_all('note') if note.has_attr('xml:id'))
+
+
+def iter_mei_note_ids(path):
+    """
+    Streams the xml:id's of the <note>s of an MEI file, in score order, without keeping the tree.
+    """
+    for _, element in etree.iterparse(path, events=('end',), tag=_mei_note, huge_tree=True):
+        note_id = element.get(_xml_id)
+        if note_id is not None:
+            yield note_id
+        element.clear()
+
+
+def parse_mei(path):
+    """
+    The whole MEI file as a tree, which can be edited and written back.
+    """
+    return etree.parse(path, _parser)
+
+
+def mei_notes(root):
+    """
+    All <mei:note> elements of a parsed MEI document, in score order.
+    """
+    return _notes(root)
+
+
+def parse_svg(svg_text):
+    """
+    Parses a Verovio SVG and returns its root element. An SVG that lxml rejects is recovered
+    with BeautifulSoup, as the scripts read SVGs before, and parsed again from its output;
+    the lxml error is raised if that is not possible either.
+    """
+    data = _as_bytes(svg_text)
+    try:
+        return etree.fromstring(data, _parser)
+    except etree.XMLSyntaxError as error:
+        if BeautifulSoup is None:
+            raise
+        soup = BeautifulSoup(data, 'xml')
+        if soup.find() is None:
+            raise
+        print(f"    > Warning: {error}; reading the SVG through BeautifulSoup instead")
+        return etree.fromstring(soup.encode('utf-8'), _parser)
+
+
+def svg_groups(element):
+    """
+    Every <g> with an id below element, in document order.
+    """
+    return _groups(element)
+
+
+def svg_systems(root):
+    """
+    The <g class="system"> groups of the score, top to bottom.
+    """
+    return _systems(root)
+
+
+def page_margin(root):
+    """
+    The <g class="page-margin"> of the score, or None.
+    """
+    return _first(_page_margin(root))
+
+
+def find_notehead(element):
+    """
+    First <g class="notehead"> below element, or None.
+    """
+    return _first(_noteheads(element))
+
+
+def find_use(element):
+    """
+    First <use> below element, or None.
+    """
+    return _first(_uses(element))
+
+
+def add_element(parent, tag, attrs, text=None):
+    """
+    Appends a new <tag> child, in parent's namespace, and returns it.
+    """
+    namespace = etree.QName(parent).namespace
+    element = parent.makeelement(f'{{{namespace}}}{tag}' if namespace else tag, attrs)
+    element.text = text
+    parent.append(element)
+    return element
+
+
+def serialize_svg(root):
+    """
+    The (edited) document as text with its XML declaration, without re-indenting it.
+    """
+    return etree.tostring(root.getroottree(), encoding='utf-8', xml_declaration=True).decode('utf-8')
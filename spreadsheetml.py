@@ -0,0 +1,102 @@
+import re
+
+import pandas as pd
+from lxml import etree
+
+SS_NS = 'urn:schemas-microsoft-com:office:spreadsheet'
+
+_worksheet = f'{{{SS_NS}}}Worksheet'
+_row = f'{{{SS_NS}}}Row'
+_cell = f'{{{SS_NS}}}Cell'
+_data = f'{{{SS_NS}}}Data'
+_name = f'{{{SS_NS}}}Name'
+_index = f'{{{SS_NS}}}Index'
+_merge_across = f'{{{SS_NS}}}MergeAcross'
+_type = f'{{{SS_NS}}}Type'
+
+_song_prefix = re.compile(r'(\d+)_')
+
+# Excel 2003 XML (SpreadsheetML) workbooks, e.g. 'All songs.xml' as exported by the annotation tool:
+#   <Workbook><Worksheet ss:Name="000_..."><Table><Row><Cell ss:Index="3"><Data ss:Type="Number">...
+# Cells may skip columns (ss:Index, 1-based) or span several (ss:MergeAcross).
+
+
+def cell_value(text, data_type):
+    """
+    The Python value of a <Data> element's text for its ss:Type.
+    """
+    if text is None or text == '':
+        return None
+    if data_type == 'Number':
+        number = float(text)
+        return int(number) if number.is_integer() and not any(c in text for c in '.eE') else number
+    if data_type == 'Boolean':
+        return text.strip() == '1'
+    if data_type == 'DateTime':
+        return pd.Timestamp(text)
+    return text
+
+
+def iter_rows(path):
+    """
+    Streams (worksheet name, [cell values]) for every row of a SpreadsheetML workbook, with
+    typed values and None for empty or skipped cells. Rows are dropped from memory once read.
+    """
+    sheet = None
+    row = []
+    for event, element in etree.iterparse(path, events=('start', 'end'), tag=(_worksheet, _row, _cell), huge_tree=True):
+        tag = element.tag
+        if event == 'start':
+            if tag == _worksheet:
+                sheet = element.get(_name)
+            elif tag == _row:
+                row = []
+            continue
+        if tag == _cell:
+            index = element.get(_index)
+            if index is not None:
+                row.extend([None] * (int(index) - 1 - len(row)))
+            data = element.find(_data)
+            # rich text puts <Font>s inside <Data>; its text is the concatenation
+            row.append(None if data is None else cell_value(''.join(data.itertext()), data.get(_type)))
+            row.extend([None] * int(element.get(_merge_across, 0)))
+        elif tag == _row:
+            yield sheet, row
+            element.clear()
+            # clear() empties the row but keeps it in its <Table>; drop the rows read before it too
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        elif tag == _worksheet:
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def read_spreadsheetml(path):
+    """
+    All worksheets of a SpreadsheetML workbook as one frame. In every worksheet the first row
+    with more than one value is the header and the rows below it are records; rows above it
+    (titles) are skipped. A song_id column is taken from the NNN_ prefix of the sheet names.
+    """
+    records = []
+    columns = []
+    header = None
+    current = None
+    for sheet, row in iter_rows(path):
+        if sheet != current:
+            current, header = sheet, None
+        if header is None:
+            if sum(value is not None for value in row) > 1:
+                header = [str(value) if value is not None else f'column_{k}' for k, value in enumerate(row)]
+                columns.extend(column for column in header if column not in columns)
+            continue
+        if all(value is None for value in row):
+            continue
+        record = dict(zip(header, row))
+        match = _song_prefix.match(sheet or '')
+        if match is not None:
+            record['song_id'] = int(match.group(1))
+        records.append(record)
+    if any('song_id' in record for record in records) and 'song_id' not in columns:
+        columns.insert(0, 'song_id')
+    return pd.DataFrame.from_records(records, columns=columns)
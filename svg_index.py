@@ -0,0 +1,82 @@
+import re
+
+from score_parsing import XLINK_NS, find_notehead, find_use, svg_groups, svg_systems
+
+_translate = re.compile(r'translate\(\s*(-?[\d.]+)[\s,]+(-?[\d.]+)')
+_unset = object()
+
+
+class SvgNote:
+    """
+    One <g id=...> of a parsed score, with its notehead lookups done at most once.
+    """
+    __slots__ = ('element', 'row', '_head', '_use', '_head_use')
+
+    def __init__(self, element, row):
+        self.element = element
+        self.row = row
+        self._head = _unset
+        self._use = _unset
+        self._head_use = _unset
+
+    @property
+    def head(self):
+        if self._head is _unset:
+            self._head = find_notehead(self.element)
+        return self._head
+
+    @property
+    def use(self):
+        """
+        The first <use> anywhere in the group.
+        """
+        if self._use is _unset:
+            self._use = find_use(self.element)
+        return self._use
+
+    @property
+    def head_use(self):
+        """
+        The <use> drawing the notehead.
+        """
+        if self._head_use is _unset:
+            head = self.head
+            self._head_use = find_use(head) if head is not None else None
+        return self._head_use
+
+
+def use_xy(use):
+    """
+    Position of a <use> element: its x/y attributes (older Verovio) or its translate() transform.
+    Raises ValueError if it has neither.
+    """
+    x, y = use.get('x'), use.get('y')
+    if x is not None and y is not None:
+        return float(x), float(y)
+    match = _translate.search(use.get('transform') or '')
+    if match is None:
+        name = use.get('id') or use.get(f'{{{XLINK_NS}}}href') or use.get('href')
+        raise ValueError(f"<use> {name!r} has neither x/y attributes nor a translate() transform")
+    return float(match.group(1)), float(match.group(2))
+
+
+def index_svg(svg_root):
+    """
+    Maps the id of every <g> in a parsed Verovio SVG (score_parsing.parse_svg) to an SvgNote, so a
+    lookup by id costs O(1) instead of a walk over the whole tree. Every group with an id is
+    indexed (notes, but also chords, beams, measures, ...). SvgNote.row is the index of the
+    enclosing <g class="system"> (None outside any system). The first group wins if an id occurs
+    twice.
+    """
+    rows = {}
+    for row, system in enumerate(svg_systems(svg_root)):
+        for g in svg_groups(system):
+            rows.setdefault(g.get('id'), row)
+
+    index = {}
+    for g in svg_groups(svg_root):
+        note_id = g.get('id')
+        if note_id not in index:
+            index[note_id] = SvgNote(g, rows.get(note_id))
+    return index
+
@@ -0,0 +1,83 @@
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
+
+# The annotation boxes and labels of create_charts_Jaccard are emitted as markup and spliced into
+# the original SVG text just before </g> of the page margin, so the score around them is written
+# back byte for byte instead of being rebuilt.
+
+
+class _Found(Exception):
+    pass
+
+
+def overlay_rect(x, y, width, height, color):
+    """
+    Markup of one annotation box.
+    """
+    return (f'<rect fill="none" height="{height}" stroke={quoteattr(str(color))} width="{width}" '
+            f'x="{x}" y="{y}" stroke-width="50"/>')
+
+
+def overlay_text(x, y, color, label):
+    """
+    Markup of one annotation label.
+    """
+    return (f'<text x="{x}" y="{y}" font-weight="bold" font-size="150" fill={quoteattr(str(color))} '
+            f'text-anchor="middle">{escape(str(label))}</text>')
+
+
+def page_margin_end(svg_text):
+    """
+    Offset of the closing tag of <g class="page-margin"> in the SVG text, or -1 if there is none
+    (or it is an empty <g/>). The offset comes from the XML parser itself, so markup inside
+    attribute values, comments or CDATA cannot throw it off; parsing stops at that tag. Raises
+    expat.ExpatError if the text before it is not well-formed XML.
+    """
+    data = svg_text.encode('utf-8')
+    parser = expat.ParserCreate()
+    depth = 0
+    margin_depth = None
+    # an empty <g/> reports its end right after the start tag, with nothing in between
+    empty = False
+    end = -1
+
+    def start(name, attrs):
+        nonlocal depth, margin_depth, empty
+        depth += 1
+        empty = False
+        if (margin_depth is None and name.rpartition(':')[2] == 'g'
+                and 'page-margin' in attrs.get('class', '').split()):
+            margin_depth = depth
+            empty = True
+
+    def text(content):
+        nonlocal empty
+        empty = False
+
+    def close(name):
+        nonlocal depth, end
+        if depth == margin_depth:
+            end = parser.CurrentByteIndex
+            raise _Found
+        depth -= 1
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = close
+    parser.CharacterDataHandler = text
+    try:
+        parser.Parse(data, True)
+    except _Found:
+        pass
+    if end < 0 or (empty and data[:end].endswith(b'/>')):
+        return -1
+    return len(data[:end].decode('utf-8'))
+
+
+def splice_overlay(svg_text, overlay, end=None):
+    """
+    Inserts the overlay markup just before </g> of the page margin. The score markup around it
+    is written back byte for byte, never re-serialised.
+    """
+    if end is None:
+        end = page_margin_end(svg_text)
+    return ''.join((svg_text[:end], *overlay, svg_text[end:]))
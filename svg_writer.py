@@ -0,0 +1,104 @@
+import gzip
+import os
+import queue
+import re
+import threading
+
+# svg: the text as produced; min: without the indentation between tags; svgz: gzip-compressed
+svg_formats = ('svg', 'min', 'svgz')
+
+# whitespace between two tags that contains a line break is layout only; whitespace inside one
+# line (e.g. between <tspan>s of a lyric) can be significant and is kept
+_indentation = re.compile(r'>\s*\n\s*<')
+
+
+def minify(svg_text):
+    return _indentation.sub('><', svg_text)
+
+
+def output_path(path, svg_format='svg'):
+    """
+    The file name an .svg output gets in the given format.
+    """
+    if svg_format == 'svgz':
+        return os.path.splitext(path)[0] + '.svgz'
+    return path
+
+
+def write_svg(path, svg_text, svg_format='svg'):
+    if svg_format == 'svgz':
+        with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as f:
+            f.write(svg_text)
+        return
+    if svg_format == 'min':
+        svg_text = minify(svg_text)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(svg_text)
+
+
+class SvgWriter:
+    """
+    Writes SVG outputs from a background thread, so minifying, compressing and disk I/O overlap
+    with building the next page. At most `pending` documents wait in memory; write() blocks
+    beyond that. The first error of the thread sticks: every later write() and close() raise it,
+    and nothing queued after it is written.
+
+        with SvgWriter('svgz') as writer:
+            path = writer.write('out.svg', svg_text)   # -> 'out.svgz'
+    """
+
+    def __init__(self, svg_format='svg', pending=4):
+        if svg_format not in svg_formats:
+            raise ValueError(f"Unknown SVG format '{svg_format}', expected one of {svg_formats}")
+        self.svg_format = svg_format
+        self._queue = queue.Queue(maxsize=pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                path, svg_text = item
+                try:
+                    write_svg(path, svg_text, self.svg_format)
+                except Exception as e:
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, path, svg_text):
+        """
+        Queues svg_text to be written to `path` (renamed for the format) and returns the final path.
+        """
+        self._raise_error()
+        path = output_path(path, self.svg_format)
+        self._queue.put((path, svg_text))
+        return path
+
+    def close(self):
+        """
+        Waits until every queued document is on disk.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # the exception leaving the with block is the one to report; a write error only gets a line
+        try:
+            self.close()
+        except Exception as e:
+            print(f"    > Warning: writing an SVG failed too: {e}")
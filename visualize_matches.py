@@ -1,9 +1,20 @@
+import argparse
+import heapq
 import json
 import random
 import os
 
-import bs4
 import verovio as vrv
+
+import match_store
+import render_scores
+from build_manifest import BuildManifest, digest, file_inputs
+from pattern_store import NoteTable, PatternRecord, note_order
+from render_pool import RenderTask, report_timings, run_tasks, score_size
+from score_parsing import add_element, page_margin, parse_svg, serialize_svg
+from svg_index import index_svg, use_xy
+from svg_writer import SvgWriter, svg_formats
+
 minWidth = 100
 minHeight = 500
 import pandas as pd
@@ -30,41 +41,175 @@ def contains_same_location(locations, new_location):
    return False, None
 
 def divide_patterns(patterns):
+   """
+   Greedy packing, longest pattern first: each pattern goes on the first page none of whose
+   patterns shares a note with it. Every note keeps a bitmask of the pages it is already on, so
+   the first free page is the lowest bit not set in the OR of the pattern's masks.
+   """
    result = []
-   sorted_patterns = sorted(patterns, key=lambda p: len(p[0]), reverse=True)
+   note_pages = {}
+   sorted_patterns = sorted(patterns, key=lambda p: len(p.codes), reverse=True)
 
    for p in sorted_patterns:
-       found_place = False
-       notes, tag, id = p
-       if len(result) > 0:
-           for i in range(len(result)):
-               # todo malo popravi
-               r = result[i]
-               notes_in_result = [ni for n, _, _ in r for ni in n]
-               if all([n not in notes_in_result for n in notes]):
-                   result[i].append(p)
-                   found_place = True
-                   break
-       if not found_place:
-           result.append([p])
+       used = 0
+       for n in p.codes:
+           used |= note_pages.get(n, 0)
+       i = (~used & (used + 1)).bit_length() - 1
+       if i == len(result):
+           result.append([])
+       result[i].append(p)
+       for n in p.codes:
+           note_pages[n] = note_pages.get(n, 0) | (1 << i)
+   return result
+
+def divide_patterns_by_interval(patterns, note_order):
+   """
+   Interval colouring: a pattern takes up the span from its first to its last note in score order
+   (note_order maps a note id to its position), and patterns whose spans overlap never share a
+   page. Going through the spans by start and reusing the page that frees up first needs the
+   fewest pages possible, the largest number of spans over any one note. Notes missing from
+   note_order have no position, so patterns sharing one of them are kept apart as in
+   divide_patterns, by a bitmask of the pages each such note is on; only those patterns can need
+   more pages. Either way no page holds two patterns with a common note.
+   """
+   spans = []
+   outside = []
+   for p in patterns:
+       note_ids = p.note_ids
+       positions = [note_order[n] for n in note_ids if n in note_order]
+       outside.append([n for n in note_ids if n not in note_order])
+       # an empty span (end before start) for patterns without notes in the score: they clash with nothing
+       spans.append((min(positions), max(positions)) if positions else (-1, -2))
+
+   result = []
+   busy = []  # (end of the last span on the page, page)
+   note_pages = {}
+   for k in sorted(range(len(patterns)), key=lambda k: spans[k]):
+       start, end = spans[k]
+       used = 0
+       for n in outside[k]:
+           used |= note_pages.get(n, 0)
+       # the page that frees up first, skipping pages that hold one of the pattern's unordered notes
+       i = None
+       skipped = []
+       while busy and busy[0][0] < start:
+           entry = heapq.heappop(busy)
+           if used >> entry[1] & 1:
+               skipped.append(entry)
+           else:
+               i = entry[1]
+               break
+       for entry in skipped:
+           heapq.heappush(busy, entry)
+       if i is None:
+           i = len(result)
+           result.append([])
+       result[i].append(patterns[k])
+       heapq.heappush(busy, (end, i))
+       for n in outside[k]:
+           note_pages[n] = note_pages.get(n, 0) | (1 << i)
    return result
 
+class PageOverlay:
+   """
+   Changes made to the parsed score for one output page, recorded so that they can be undone
+   after the page is written and the same tree reused for the next page.
+   """
+
+   def __init__(self):
+       self.attrs = []
+       self.added = []
+
+   def set(self, element, name, value):
+       self.attrs.append((element, name, element.get(name)))
+       element.set(name, value)
+
+   def add(self, parent, tag, attrs, text=None):
+       self.added.append((parent, add_element(parent, tag, attrs, text)))
+
+   def undo(self):
+       for parent, element in reversed(self.added):
+           parent.remove(element)
+       for element, name, value in reversed(self.attrs):
+           if value is None:
+               element.attrib.pop(name, None)
+           else:
+               element.set(name, value)
+       self.attrs = []
+       self.added = []
+
 def fill_pat_list(matches, ids, n):
    pats = []
    added = set()
    for m in matches:
 
-       if m[n][2] in ids and m[n][2] not in added:
+       if m[n].row_id in ids and m[n].row_id not in added:
            pats.append(m[n])
-           added.add(m[n][2])
+           added.add(m[n].row_id)
    return pats
 
-def visualize_matches(matches):
-   song_files = os.listdir('output_svgs_mei')
-   with open(matches, 'r') as f:
+def bucket_matches(matches, pat1_pages, pat2_pages):
+   """
+   Groups the matches by the (page of pattern 1, page of pattern 2) they are drawn on, looked up by
+   pattern row id. Within a bucket the matches keep their order.
+   """
+   page1 = {p.row_id: i for i, page in enumerate(pat1_pages) for p in page}
+   page2 = {p.row_id: j for j, page in enumerate(pat2_pages) for p in page}
+   buckets = {}
+   for match in matches:
+       buckets.setdefault((page1[match[0].row_id], page2[match[1].row_id]), []).append(match)
+   return buckets
+
+def load_json_matches(path):
+   """
+   Reads a legacy results/*.json file into (record1, record2, match_type) triples. Each pattern becomes
+   a single PatternRecord shared by all of its matches, over one NoteTable for the song.
+   """
+   with open(path, 'r') as f:
        matches_data = json.load(f)
-   song_id, user1, user2 = os.path.basename(matches).split('_')
-   user2 = user2.split('.')[0]
+   table = NoteTable()
+   records = {}
+
+   def record(pattern):
+       notes, tag, row_id = pattern
+       if row_id not in records:
+           records[row_id] = PatternRecord(table.encode(notes), tag, row_id, table)
+       return records[row_id]
+
+   return [(record(p1), record(p2), match_type) for p1, p2, match_type in matches_data]
+
+def load_matches(song_id, user1, user2):
+   # the binary match store written by analyse_matches, or the legacy json results
+   if match_store.has_pair(song_id, user1, user2):
+       return match_store.load_pair(song_id, user1, user2)
+   return load_json_matches(os.path.join('results', f'{song_id}_{user1}_{user2}.json'))
+
+def draw_matches(song_id, user1, user2, writer, incremental=False, packing='greedy', skip_empty=False, manifest=None):
+   """
+   visualize_matches, with the pages handed to `writer` (an svg_writer.SvgWriter).
+   """
+   song_files = os.listdir('output_svgs_mei')
+   if user1 is None:
+       matches_path = song_id
+       song_id, user1, user2 = (int(part) for part in os.path.basename(matches_path)[:-len('.json')].split('_'))
+       matches_data = load_json_matches(matches_path)
+   else:
+       matches_data = load_matches(song_id, user1, user2)
+   song_paths = [f for f in song_files if int(f[:3]) == int(song_id)]
+
+   # the pages of a pair are redrawn only if its matches or the score SVG changed
+   own_manifest = manifest is None
+   if own_manifest:
+       manifest = BuildManifest()
+   key = f'{song_id}/{user1}_{user2}'
+   inputs = digest([(p1.to_json(), p2.to_json(), match_type) for p1, p2, match_type in matches_data],
+                   file_inputs([os.path.join('output_svgs_mei', f) for f in song_paths]), packing, skip_empty,
+                   writer.svg_format)
+   if incremental and manifest.is_current('match_svgs', key, inputs):
+       return
+   # the score order of the notes, which the SVG's <g> order does not follow (chords, layers, ...)
+   order = note_order(song_id) if packing == 'interval' else None
+   outputs = []
    colors = {
        user1: 'red',
        user2: 'blue',
@@ -72,39 +217,45 @@ def visualize_matches(matches):
        contained: 'violet',
    }
 
-   song_paths = [f for f in song_files if int(f[:3]) == int(song_id)]
    for song_path in song_paths:
        svg_output = open(os.path.join('output_svgs_mei', song_path), 'r').read()
 
-       svg_soup = bs4.BeautifulSoup(svg_output, 'xml')
-       page_margin = svg_soup.find('g', attrs={'class': 'page-margin'})
+       svg_root = parse_svg(svg_output)
+       margin = page_margin(svg_root)
+       svg_notes = index_svg(svg_root)
        obj_locs = []
        if (not os.path.exists(f'{output_folder}/{song_id}')):
            os.makedirs(f'{output_folder}/{song_id}')
 
-       pats_us1_ids = {p1[2] for p1, p2, matchtype in matches_data}
+       pats_us1_ids = {p1.row_id for p1, p2, matchtype in matches_data}
        pats_us1 = fill_pat_list(matches_data, pats_us1_ids, 0)
-       pats_us2_ids = {p2[2] for p1, p2, matchtype in matches_data}
+       pats_us2_ids = {p2.row_id for p1, p2, matchtype in matches_data}
        pats_us2 = fill_pat_list(matches_data, pats_us2_ids, 1)
 
-       pat1_pages = divide_patterns(pats_us1)
-       pat2_pages = divide_patterns(pats_us2)
+       if order is not None:
+           pat1_pages = divide_patterns_by_interval(pats_us1, order)
+           pat2_pages = divide_patterns_by_interval(pats_us2, order)
+       else:
+           pat1_pages = divide_patterns(pats_us1)
+           pat2_pages = divide_patterns(pats_us2)
        print(len(pat1_pages), len(pat2_pages))
+       page_matches = bucket_matches(matches_data, pat1_pages, pat2_pages)
 
+       song_name = song_path.split('.')[0]
+       pages = []
        for i, pat1_page in enumerate(pat1_pages):
            for j, pat2_page in enumerate(pat2_pages):
-               svg_output = open(os.path.join('output_svgs_mei', song_path), 'r').read()
-               svg_soup = bs4.BeautifulSoup(svg_output, 'xml')
-               page_margin = svg_soup.find('g', attrs={'class': 'page-margin'})
-               for match in matches_data:
+               if skip_empty and (i, j) not in page_matches:
+                   continue
+               # the score is parsed once per song; each page only applies (and then undoes) its overlay
+               overlay = PageOverlay()
+               for match in page_matches.get((i, j), ()):
                    pat1, pat2, match_type = match
-                   if pat1 not in pat1_page:
-                       continue
-                   if pat2 not in pat2_page:
-                       continue
 
-                   notes1, tag1, id1 = pat1
-                   notes2, tag2, id2 = pat2
+                   notes1 = pat1.note_ids
+                   notes2 = pat2.note_ids
+                   notes1_set = set(notes1)
+                   notes2_set = set(notes2)
 
                    first_note = None
                    last_note = None
@@ -113,11 +264,12 @@ def visualize_matches(matches):
                    last_notes = [notes1[1], notes2[1]]
 
                    for noteid in notes1:
-                       note_obj = svg_soup.find('g', id=noteid)
-                       if note_obj is None:
+                       svg_note = svg_notes.get(noteid)
+                       if svg_note is None:
                            continue
+                       note_obj = svg_note.element
                        color = ''
-                       if noteid not in notes2:
+                       if noteid not in notes2_set:
                            #user1 color
                            color = colors[user1]
                        elif match_type == intersect:
@@ -127,15 +279,14 @@ def visualize_matches(matches):
                            # violet
                            color = colors[contained]
 
-                       note_obj['color'] = color
-                       head = note_obj.find('g', class_='notehead')
+                       overlay.set(note_obj, 'color', color)
+                       head = svg_note.head
                        if head is not None:
-                           head['fill'] = color
+                           overlay.set(head, 'fill', color)
                            if noteid in first_notes or noteid in last_notes:
-                               use = head.find('use')
+                               use = svg_note.head_use
                                if use is not None:
-                                   x = float(use['x'])
-                                   y = float(use['y'])
+                                   x, y = use_xy(use)
                                    # we need to check if it is in the same row or not
                                    if first_note is None:
                                        first_note = (x, y)
@@ -149,21 +300,21 @@ def visualize_matches(matches):
                                        xi, yi = last_note
                                        if (x>xi and abs(float(y) - float(yi))<line_height) or (float(y) > yi - line_height):
                                            last_note = (x, y)
-                   for noteid in pat2:
-                       if noteid not in pat1:
-                           note_obj = svg_soup.find('g', id=noteid)
-                           if note_obj is None:
+                   for noteid in notes2:
+                       if noteid not in notes1_set:
+                           svg_note = svg_notes.get(noteid)
+                           if svg_note is None:
                                continue
+                           note_obj = svg_note.element
                            color = colors[user2]
 
-                           note_obj['color'] = color
-                           head = note_obj.find('g', class_='notehead')
+                           overlay.set(note_obj, 'color', color)
+                           head = svg_note.head
                            if head is not None:
-                               head['fill'] = color
-                               use = head.find('use')
+                               overlay.set(head, 'fill', color)
+                               use = svg_note.head_use
                                if use is not None:
-                                   x = float(use['x'])
-                                   y = float(use['y'])
+                                   x, y = use_xy(use)
                                    # we need to check if it is in the same row or not
                                    if first_note is None:
                                        first_note = (x, y)
@@ -184,9 +335,9 @@ def visualize_matches(matches):
                        y1_start = str(float(first_note[1]) - 250)
                        y1_end = str(float(first_note[1]) + 250)
 
-                       start_line_tag = svg_soup.new_tag(
-                           'line',
-                           attrs={
+                       overlay.add(
+                           margin, 'line',
+                           {
                                'x1': str(first_note[0]),  # Ensure all attributes are strings
                                'y1': y1_start,
                                'x2': str(first_note[0]),
@@ -194,25 +345,23 @@ def visualize_matches(matches):
                                'style': 'stroke:black;stroke-width:20'
                            }
                        )
-                       page_margin.append(start_line_tag)
-                       text1 = svg_soup.new_tag(
-                           'text',
-                           attrs={
+                       overlay.add(
+                           margin, 'text',
+                           {
                                'x': str(last_note[0]),
                                'y': y1_start,
                                'fill': 'green',
                                'font-size': '100pt'
-                           }
+                           },
+                           match_type + ' ' + pat1.tag + ' ' + pat2.tag
                        )
-                       text1.string = match_type + ' ' + pat1[1] + ' ' + pat2[1]
-                       page_margin.append(text1)
                        # Create the second line tag (for the end note)
                        y2_start = str(float(last_note[1]) - line_height//2)
                        y2_end = str(float(last_note[1]) + line_height//2)
 
-                       end_line_tag = svg_soup.new_tag(
-                           'line',
-                           attrs={
+                       overlay.add(
+                           margin, 'line',
+                           {
                                'x1': str(last_note[0] + 250),
                                'y1': y2_start,
                                'x2': str(last_note[0] + 250),
@@ -220,28 +369,109 @@ def visualize_matches(matches):
                                'style': 'stroke:black;stroke-width:20'
                            }
                        )
-                       page_margin.append(end_line_tag)
-                       text2 = svg_soup.new_tag(
-                           'text',
-                           attrs={
+                       overlay.add(
+                           margin, 'text',
+                           {
 
                                'x': str(last_note[0] + 250),
                                'y': y2_end,
                                'fill': 'blue',
                                'font-size': '100pt'
-                           }
+                           },
+                           match_type + ' ' + pat1.tag + ' ' + pat2.tag
                        )
-                       text2.string = match_type + ' ' + pat1[1] + ' ' + pat2[1]
-                       page_margin.append(text2)
-               song_name = song_path.split('.')[0]
                if not os.path.exists(output_folder):
                    os.makedirs(output_folder)
-               path = os.path.join(output_folder, f'{song_name}_{user1}_{user2}_{i}_{j}.svg')
+               # serialised before the overlay is undone; minified, compressed and written in the background
+               path = writer.write(os.path.join(output_folder, f'{song_name}_{user1}_{user2}_{i}_{j}.svg'),
+                                   serialize_svg(svg_root))
+               outputs.append(path)
+               pages.append({'i': i, 'j': j, 'file': os.path.basename(path), 'matches': len(page_matches.get((i, j), ()))})
+               overlay.undo()
+
+       if not os.path.exists(output_folder):
+           os.makedirs(output_folder)
+       index_path = os.path.join(output_folder, f'{song_name}_{user1}_{user2}_pages.json')
+       with open(index_path, 'w') as f:
+           json.dump({'song_id': song_id, 'user1': user1, 'user2': user2, 'score': song_path,
+                      'pat1_pages': len(pat1_pages), 'pat2_pages': len(pat2_pages), 'pages': pages}, f, indent=1)
+       outputs.append(index_path)
+   manifest.record('match_svgs', key, inputs, outputs)
+   if own_manifest:
+       manifest.save()
+
+def visualize_matches(song_id, user1=None, user2=None, incremental=False, packing='greedy', skip_empty=False, svg_format='svg',
+                      manifest=None):
+   """
+   Draws the matches of one user pair in one song. The old form visualize_matches(path), with the
+   path of a results/{song}_{user1}_{user2}.json file, still works and reads that file.
+
+   packing='interval' packs the patterns of each user with divide_patterns_by_interval, over the
+   order of the notes in the song's MEI (pattern_store.note_order): the fewest pages (and i x j
+   outputs) that keep overlapping spans apart. A song without an MEI falls back to greedy packing.
+
+   With skip_empty=True only page combinations with at least one match are written. Either way
+   {song}_{user1}_{user2}_pages.json lists the pages that exist, with their match counts.
+
+   svg_format 'min' or 'svgz' writes the pages without indentation or gzip-compressed (svg_writer).
+
+   The pages are recorded in `manifest`, or in build_manifest.json if none is given.
+   """
+   with SvgWriter(svg_format) as writer:
+      draw_matches(song_id, user1, user2, writer, incremental, packing, skip_empty, manifest)
+
+def _visualize_task(song_id, user1, user2, options):
+   # workers record into a copy of the manifest; the parent collects the entries and saves once
+   manifest = BuildManifest()
+   visualize_matches(song_id, user1, user2, manifest=manifest, **options)
+   return manifest.recorded.get('match_svgs', {}).get(f'{song_id}/{user1}_{user2}')
+
+def visualize_all(users, song_ids=range(22), workers=1, memory_budget=None, **options):
+   """
+   Visualizes every user pair of every song that has matches, spread over `workers` processes by
+   render_pool: largest scores first, one pair of a score at a time, within memory_budget bytes.
+   """
+   song_files = os.listdir('output_svgs_mei')
+   tasks = []
+   for song_id in song_ids:
+       size = score_size(os.path.join('output_svgs_mei', f) for f in song_files if int(f[:3]) == int(song_id))
+       for a in range(len(users)):
+           for b in range(a + 1, len(users)):
+               user1, user2 = users[a], users[b]
+               if match_store.has_pair(song_id, user1, user2) or os.path.exists(
+                       os.path.join('results', f'{song_id}_{user1}_{user2}.json')):
+                   tasks.append(RenderTask(f'{song_id}/{user1}_{user2}', song_id, size,
+                                           _visualize_task, song_id, user1, user2, options))
 
-               with open(path, 'w') as f:
-                   f.write(svg_soup.prettify())
+   results = run_tasks(tasks, workers, memory_budget)
+   manifest = BuildManifest()
+   for task, entry, seconds in results:
+       if entry is not None:
+           manifest.record('match_svgs', task.label, entry['inputs'], entry['outputs'])
+   manifest.save()
+   report_timings(results)
 
 if __name__ == '__main__':
-   path = 'results/0_36_46.json'
-   visualize_matches(path)
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--incremental', action='store_true',
+                       help='skip the pair if its matches and score did not change (build_manifest.json)')
+   parser.add_argument('--packing', choices=['greedy', 'interval'], default='greedy',
+                       help='interval: fewest pages, no two patterns with overlapping note spans on one page')
+   parser.add_argument('--skip-empty', action='store_true', help='only write page combinations with at least one match')
+   parser.add_argument('--all', action='store_true', help='every user pair of every song, instead of song 0, users 36 and 46')
+   parser.add_argument('--workers', type=int, default=1, help='number of worker processes (with --all)')
+   parser.add_argument('--memory-budget', type=float, metavar='MB', help='estimated memory the workers may use together')
+   parser.add_argument('--format', choices=svg_formats, default='svg',
+                       help='min: SVG without indentation, svgz: gzip-compressed SVG')
+   parser.add_argument('--render', action='store_true', help='render missing or outdated score SVGs first (render_scores.py)')
+   args = parser.parse_args()
+   if args.render:
+       render_scores.render_all(workers=args.workers)
+   options = {'incremental': args.incremental, 'packing': args.packing, 'skip_empty': args.skip_empty,
+              'svg_format': args.format}
+   if args.all:
+       visualize_all([36, 46, 48, 49, 51], workers=args.workers,
+                     memory_budget=args.memory_budget * 1e6 if args.memory_budget else None, **options)
+   else:
+       visualize_matches(0, 36, 46, **options)
 